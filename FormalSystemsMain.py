@@ -1,9 +1,16 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
+from __future__ import print_function
+
+import os
 import argparse
 
 from formalsystems.formalsystems import FormalSystem, Theorem
+from formalsystems.sampling import UniformDepth, sample_parallel
+from formalsystems.storage import ClosureWriter, ClosureFile
+from formalsystems.rewriting import RewriteOrder
+from formalsystems.metrics import Metrics, Progress, serve
 
 
 def main():
@@ -31,27 +38,102 @@ def main():
                         default=None,
                         help='check axiom definition')
 
+    parser.add_argument('-g', '--graph',
+                        action='store_true',
+                        help='print rule dependency graph (DOT format)')
+
+    parser.add_argument('-S', '--sample',
+                        type=int,
+                        default=None,
+                        help='sample theorems with random derivations, '
+                             'of depth up to the max iteration')
+
+    parser.add_argument('--seed',
+                        type=int,
+                        default=None,
+                        help='random seed for sampling')
+
+    parser.add_argument('-p', '--processes',
+                        type=int,
+                        default=None,
+                        help='number of processes for sampling (default all CPUs)')
+
+    parser.add_argument('-c', '--commute',
+                        action='store_true',
+                        help='apply commuting rewrites in one order only '
+                             '(rules with one premise)')
+
+    parser.add_argument('-o', '--output',
+                        default=None,
+                        help='save the closure to a binary file')
+
+    parser.add_argument('-r', '--resume',
+                        default=None,
+                        help='start from the last generation of a saved closure '
+                             '(step algorithm only), steps keep its numbering')
+
     parser.add_argument('-i', '--iteration',
                         type=int,
                         default=10,
-                        help='define max iteration (default 10)')
+                        help='define max iteration (default 10), '
+                             'new generations with --resume')
+
+    parser.add_argument('-v', '--verbose',
+                        action='store_true',
+                        help='print each rule application (slow)')
+
+    parser.add_argument('--progress',
+                        type=float,
+                        default=None,
+                        metavar='SECONDS',
+                        help='print a progress line every SECONDS on stderr')
+
+    parser.add_argument('--metrics-port',
+                        type=int,
+                        default=None,
+                        metavar='PORT',
+                        help='export metrics in Prometheus format '
+                             'on http://localhost:PORT/metrics')
 
     parser.add_argument('-q', '--quiet',
                         action='store_true',
-                        help='quiet mode')
+                        help='with --axiom, no details; with --sample, '
+                             'only theorems, without derivations')
 
     args = parser.parse_args()
 
     fs = FormalSystem()
     fs.read_formal_system(args.yaml_file)
 
+    if args.commute:
+        try:
+            fs.order = RewriteOrder(fs.rules)
+        except ValueError as e:
+            parser.error(str(e))
+
     infinite_axioms = any(ax.wildcards for ax in fs.axioms)
     and_in_rule = any(len(r.oldts) > 1 for r in fs.rules)
 
     if args.schema is not None:
-        print '> Generating axioms schema'
+        print('> Generating axioms schema')
         for ax in fs.iterate_over_schema(max_iter=args.iteration):
-            print ax
+            print(ax)
+        return
+
+    if args.graph:
+        print(fs.graph.to_dot())
+        return
+
+    if args.sample is not None:
+        for th in sample_parallel(args.yaml_file,
+                                  args.sample,
+                                  seed=args.seed,
+                                  depth=UniformDepth(1, args.iteration),
+                                  processes=args.processes):
+            if args.quiet:
+                print(th)
+            else:
+                fs.th_to_derivation(th, th, verbose=True)
         return
 
     if args.axiom is not None:
@@ -59,38 +141,88 @@ def main():
         return
 
     if infinite_axioms:
-        print '> Infinite number of axioms, using bucket algorithm'
+        print('> Infinite number of axioms, using bucket algorithm')
     else:
-        print '> Finite number of axioms, using step algorithm'
+        print('> Finite number of axioms, using step algorithm')
 
     if and_in_rule:
-        print '> Rule with several parents, using recursivity'
-    print
+        print('> Rule with several parents, using recursivity')
+    print()
+
+    saved = None
+    start = 1
+    step = args.iteration
+    if args.resume is None:
+        ths = fs.iterate_over_schema()
+    else:
+        if infinite_axioms:
+            parser.error('--resume only works with the step algorithm')
+        if args.output is not None and \
+           os.path.abspath(args.output) == os.path.abspath(args.resume):
+            parser.error('--output must differ from --resume')
+        saved = ClosureFile(args.resume, fs)
+        ths = saved.frontier()
+        # Steps are numbered after the saved generations
+        start = saved.generations
+        step = start + args.iteration
+
+    writer = None
+    if args.output is not None:
+        # Saved generations are copied, new ones follow them
+        writer = ClosureWriter(args.output, resume=saved)
+
+    if saved is not None:
+        saved.close()
+
+    progress = server = None
+    if args.progress is not None or args.metrics_port is not None:
+        fs.metrics = Metrics()
+        fs.metrics.generation = start
+    if args.progress is not None:
+        progress = Progress(fs.metrics, args.progress)
+        progress.start()
+    if args.metrics_port is not None:
+        server = serve(fs.metrics, args.metrics_port)
 
     # Main
     if args.theorem is None:
         if infinite_axioms:
-            fs.apply_rules_bucket_till(fs.iterate_over_schema(),
+            fs.apply_rules_bucket_till(ths,
                                        min_len=None,  # wont apply
                                        max_turns=args.iteration,
                                        full=and_in_rule,
-                                       verbose=not(args.quiet))
+                                       verbose=args.verbose,
+                                       writer=writer)
         else:
-            fs.apply_rules_step(fs.iterate_over_schema(),
-                                step=args.iteration,
-                                verbose=not(args.quiet))
+            fs.apply_rules_step(ths,
+                                step=step,
+                                verbose=args.verbose,
+                                writer=writer,
+                                start=start)
     else:
         if infinite_axioms:
-            fs.derivation_asc(fs.iterate_over_schema(),
+            fs.derivation_asc(ths,
                               args.theorem,
                               max_turns=args.iteration,
                               full=and_in_rule,
-                              verbose=not(args.quiet))
+                              verbose=args.verbose,
+                              writer=writer)
         else:
-            fs.derivation_step(fs.iterate_over_schema(),
+            fs.derivation_step(ths,
                                args.theorem,
-                               step=args.iteration,
-                               verbose=not(args.quiet))
+                               step=step,
+                               verbose=args.verbose,
+                               writer=writer,
+                               start=start)
+
+    if writer is not None:
+        writer.close()
+
+    if progress is not None:
+        progress.stop()
+        print(fs.metrics.line(), file=progress.stream)
+    if server is not None:
+        server.shutdown()
 
 
 if __name__ == '__main__':
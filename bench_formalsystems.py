@@ -0,0 +1,85 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Throughput benchmarks, in theorems produced per second.
+
+Run it with several interpreters to compare them:
+
+    $ python2 bench_formalsystems.py
+    $ python3 bench_formalsystems.py
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import platform
+import timeit
+
+# Managing path
+DIRNAME = os.path.abspath(os.path.dirname(__file__))
+
+if DIRNAME not in sys.path:
+    sys.path.append(DIRNAME)
+
+from formalsystems.formalsystems import FormalSystem
+from formalsystems.rewriting import RewriteOrder
+
+
+def load(name):
+    fs = FormalSystem()
+    fs.read_formal_system(os.path.join(DIRNAME, 'definitions', name))
+    return fs
+
+
+def bench_step(name, step, commute=False):
+    fs = load(name)
+    if commute:
+        fs.order = RewriteOrder(fs.rules)
+
+    def run():
+        n = 0
+        for i, ths in fs._apply_rules_step(fs.iterate_over_schema(), verbose=False):
+            n += len(ths)
+            if i >= step:
+                return n
+
+    return run
+
+
+def bench_bucket(name, turns, full=False):
+    fs = load(name)
+
+    def run():
+        n = 0
+        for turn, bucket in fs._apply_rules_bucket(fs.iterate_over_schema(),
+                                                   full=full,
+                                                   verbose=False):
+            n += len(bucket)
+            if turn >= turns:
+                return n
+
+    return run
+
+
+BENCHMARKS = [
+    ('MIU step 7', bench_step('MIU.yaml', 7)),
+    ('MIU step 7 commute', bench_step('MIU.yaml', 7, commute=True)),
+    ('pg bucket 40', bench_bucket('pg.yaml', 40)),
+    ('fg bucket 40', bench_bucket('fg.yaml', 40)),
+    ('NDP bucket full 10', bench_bucket('NDP.yaml', 10, full=True)),
+]
+
+
+def main(repeat=3):
+    print('%s %s' % (platform.python_implementation(), platform.python_version()))
+
+    for name, run in BENCHMARKS:
+        n = run()
+        best = min(timeit.repeat(run, number=1, repeat=repeat))
+        print('%-20s %8d theorems  %8.3fs  %10.0f th/s' % (name, n, best, n / best))
+
+
+if __name__ == '__main__':
+    main()
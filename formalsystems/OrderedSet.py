@@ -2,12 +2,15 @@
 From http://code.activestate.com/recipes/576694/ (r7)
 """
 
-import collections
+try:
+    from collections.abc import MutableSet
+except ImportError:  # Python 2
+    from collections import MutableSet
 
 KEY, PREV, NEXT = range(3)
 
 
-class OrderedSet(collections.MutableSet):
+class OrderedSet(MutableSet):
 
     def __init__(self, iterable=None):
         self.end = end = []
@@ -22,6 +25,12 @@ class OrderedSet(collections.MutableSet):
     def __contains__(self, key):
         return key in self.map
 
+    def get(self, key, default=None):
+        """The element of the set equal to key, or default."""
+        if key in self.map:
+            return self.map[key][KEY]
+        return default
+
     def add(self, key):
         if key not in self.map:
             end = self.end
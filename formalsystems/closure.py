@@ -0,0 +1,145 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Shared closure of a formal system, for multithreaded use.
+
+One thread extends the closure step by step, like the step algorithm,
+while any number of threads read consistent snapshots of it.
+Snapshots are immutable, so readers never take the writer lock:
+the writer builds the next generation aside, then publishes it
+by swapping a single reference.
+"""
+
+import threading
+import time
+
+from .formalsystems import FormalSystem
+from .OrderedSet import OrderedSet
+
+
+class ClosureSnapshot(object):
+    """Immutable view of the closure at a given generation.
+
+    - generation is the step number (1 for the starting theorems)
+    - frontier holds the theorems produced at this generation
+    - theorems holds all distinct theorems so far, in discovery order
+    """
+    __slots__ = ('generation', 'frontier', 'theorems', '_index')
+
+    def __init__(self, generation, frontier, previous=None):
+        self.generation = generation
+        self.frontier = tuple(frontier)
+
+        if previous is None:
+            index = {}
+            theorems = []
+        else:
+            # Copies, previous snapshot may be read concurrently
+            index = dict(previous._index)
+            theorems = list(previous.theorems)
+
+        for th in self.frontier:
+            if th.string not in index:
+                # We keep the first occurrence, with the shortest derivation
+                index[th.string] = th
+                theorems.append(th)
+
+        self._index = index
+        self.theorems = tuple(theorems)
+
+    def __len__(self):
+        return len(self.theorems)
+
+    def __iter__(self):
+        return iter(self.theorems)
+
+    def __contains__(self, th):
+        return str(th) in self._index
+
+    def get(self, th):
+        return self._index.get(str(th))
+
+    def derivation(self, th):
+        return FormalSystem.th_to_derivation(th, self.get(th), verbose=False)
+
+
+class SharedClosure(object):
+    """Closure of a formal system, extended by steps.
+
+    >>> fs = FormalSystem()
+    >>> fs.read_formal_system('./definitions/MIU.yaml')
+    >>> closure = SharedClosure(fs, fs.iterate_over_schema())
+    >>> snap = closure.extend(2)
+    >>> snap.generation
+    3
+    >>> '/'.join(str(t) for t in snap.frontier)
+    'MIIU/MIUIU/MIIII'
+    >>> 'MII' in snap, 'MU' in snap
+    (True, False)
+    >>> closure.extend(1).generation
+    4
+    >>> snap.generation
+    3
+    """
+    def __init__(self, fs, ths):
+        self.fs = fs
+        # Writers are serialized, readers only wait on publications
+        self._writer = threading.Lock()
+        self._published = threading.Condition(threading.Lock())
+        self._snapshot = ClosureSnapshot(1, OrderedSet(ths))
+
+    def snapshot(self):
+        """Current snapshot, without locking."""
+        return self._snapshot
+
+    @property
+    def generation(self):
+        return self._snapshot.generation
+
+    def extend(self, n_steps=1):
+        """Compute n_steps more generations, and return the last snapshot.
+
+        Concurrent calls are serialized, each generation is published
+        as soon as it is computed.
+        """
+        with self._writer:
+            snap = self._snapshot
+
+            for _ in range(n_steps):
+                current = OrderedSet(snap.frontier)
+                frontier = self.fs.collect(self.fs.apply_rules(current, verbose=False))
+                snap = ClosureSnapshot(snap.generation + 1, frontier, snap)
+
+                with self._published:
+                    self._snapshot = snap
+                    self._published.notify_all()
+
+            return snap
+
+    def wait_for(self, generation, timeout=None):
+        """Block until generation is published, or timeout expires.
+
+        Return the current snapshot, whose generation may be lower
+        than requested if the timeout expired.
+        """
+        if timeout is not None:
+            deadline = time.time() + timeout
+
+        with self._published:
+            while self._snapshot.generation < generation:
+                if timeout is None:
+                    self._published.wait()
+                    continue
+
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._published.wait(remaining)
+
+            return self._snapshot
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
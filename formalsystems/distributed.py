@@ -0,0 +1,382 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Closure partitioned across several local worker processes.
+
+Theorems are sharded by a stable hash of their string. Each worker
+owns its shard: it stores the theorems, deduplicates them, and applies
+the rules on them. New theorems are sent in batches straight to the
+inbox of their owning shard, so no process holds a whole generation.
+The coordinator runs the same steps as the step algorithm, and is
+only a barrier between generations.
+
+Each theorem is identified by a reference (shard, index), and stores
+the references of its parents, so derivations can be rebuilt across
+shards.
+"""
+
+from __future__ import absolute_import
+
+import zlib
+import multiprocessing
+from collections import defaultdict
+from itertools import product
+
+from .formalsystems import FormalSystem, Theorem
+
+
+def shard_of(string, n_shards):
+    """Stable across processes, unlike hash() with randomization.
+
+    >>> shard_of('MIU', 1)
+    0
+    >>> shard_of('MIU', 3) == shard_of('MIU', 3)
+    True
+    """
+    return zlib.crc32(string.encode('utf-8')) % n_shards
+
+
+# Number of records per message between processes
+BATCH = 1000
+
+
+class ShardAborted(Exception):
+    """Another shard failed while theorems were exchanged."""
+
+
+class Shard(object):
+    """State of a worker, its part of the closure.
+
+    Records are (string, rule name, parent references), rule name
+    being None for theorems given as starting points.
+
+    inboxes are the queues of all shards, messages being (kind, batch),
+    with a batch of None marking the end of kind from a shard.
+    A shard which fails sends ('abort', None) instead, so the others
+    stop waiting for it.
+    """
+    def __init__(self, fs, shard, n_shards, inboxes=None):
+        self.fs = fs
+        self.shard = shard
+        self.n_shards = n_shards
+        self.inboxes = inboxes
+        self.records = []
+        # string -> index of the first record, for membership
+        self.index = {}
+        # indexes of records in the current generation
+        self.frontier = []
+        self._incoming = []
+        self._side = []
+        # kind -> number of end markers received
+        self._ends = defaultdict(int)
+
+        self.rules = dict((r.name, r) for r in fs.rules)
+        # Premises after the first one, for rules with several premises
+        self.side_premises = [(rule, k)
+                              for rule in fs.rules if len(rule.oldts) > 1
+                              for k in range(1, len(rule.oldts))]
+
+    def _theorem(self, ref, string, rule):
+        th = Theorem(string, p_rule=self.rules.get(rule))
+        th.ref = ref
+        return th
+
+    def receive(self, records):
+        """Store records for the next generation."""
+        self._incoming.extend(records)
+        return len(records)
+
+    def _accept(self, kind, batch):
+        if kind == 'side':
+            self._side.extend(batch)
+        else:
+            self._incoming.extend(batch)
+
+    def _post(self, shard, kind, batch):
+        if shard == self.shard:
+            self._accept(kind, batch)
+        else:
+            self.inboxes[shard].put((kind, batch))
+
+    def _exchange(self, kind, items):
+        """Send items (shard, item) to their shards in batches, and
+        receive the ones of the other shards, until they are all done.
+        """
+        batches = [[] for _ in range(self.n_shards)]
+        for shard, item in items:
+            batches[shard].append(item)
+            if len(batches[shard]) >= BATCH:
+                self._post(shard, kind, batches[shard])
+                batches[shard] = []
+
+        for shard, batch in enumerate(batches):
+            if batch:
+                self._post(shard, kind, batch)
+            if shard != self.shard:
+                self.inboxes[shard].put((kind, None))
+
+        # Faster shards may already send their records
+        # while we wait for the end of the side theorems
+        while self._ends[kind] < self.n_shards - 1:
+            k, batch = self.inboxes[self.shard].get()
+            if k == 'abort':
+                raise ShardAborted('Shard %s stopped, another shard failed' % self.shard)
+            if batch is None:
+                self._ends[k] += 1
+            else:
+                self._accept(k, batch)
+        self._ends[kind] = 0
+
+    def _abort(self):
+        for shard in range(self.n_shards):
+            if shard != self.shard:
+                self.inboxes[shard].put(('abort', None))
+
+    def swap(self):
+        """Next generation, deduplicated like an OrderedSet."""
+        seen = set()
+        self.frontier = []
+
+        for string, rule, parents in self._incoming:
+            if string in seen:
+                continue
+            seen.add(string)
+
+            self.index.setdefault(string, len(self.records))
+            self.frontier.append(len(self.records))
+            self.records.append((string, rule, parents))
+
+        self._incoming = []
+        return len(self.frontier)
+
+    def side(self):
+        """Theorems of the current generation which may match a premise
+        other than the first, for rules with several premises.
+        """
+        side = []
+        for i in self.frontier:
+            string, rule, _ = self.records[i]
+            if any(rule_.match(rule_.oldts[k], string)[1]
+                   for rule_, k in self.side_premises):
+                side.append(((self.shard, i), string, rule))
+        return side
+
+    def step(self):
+        """Apply rules on the current generation.
+
+        The first premise is taken in this shard, the others among
+        the side theorems of all shards, exchanged first. New records
+        are sent to their owning shards, for the next generation.
+        Return the number of records produced.
+        """
+        try:
+            return self._step()
+        except ShardAborted:
+            raise
+        except Exception:
+            # Other shards would wait forever for our end markers
+            self._abort()
+            raise
+
+    def _step(self):
+        if self.side_premises:
+            self._exchange('side', ((shard, t) for t in self.side()
+                                    for shard in range(self.n_shards)))
+
+        own = [self._theorem((self.shard, i), self.records[i][0], self.records[i][1])
+               for i in self.frontier]
+        side = [self._theorem(ref, string, rule) for ref, string, rule in self._side]
+        self._side = []
+
+        produced = [0]
+
+        def records():
+            for rule in self.fs.rules:
+                pools = [own] + [side] * (len(rule.oldts) - 1)
+
+                for t_ths in product(*pools):
+                    for nth in rule.produce_one(t_ths, verbose=False, cache=self.fs.cache):
+                        if nth is None:
+                            continue
+                        produced[0] += 1
+                        yield (shard_of(nth.string, self.n_shards),
+                               (nth.string, rule.name, tuple(t.ref for t in t_ths)))
+
+        self._exchange('records', records())
+        return produced[0]
+
+    def get(self, i):
+        return self.records[i]
+
+    def lookup(self, string):
+        """Reference of the first record of string, or None."""
+        i = self.index.get(string)
+        if i is None:
+            return
+        return self.shard, i
+
+    def generation(self):
+        return [self.records[i][0] for i in self.frontier]
+
+    def size(self):
+        return len(self.index)
+
+
+def _serve(conn, source, shard, inboxes):
+    fs = FormalSystem()
+    fs.read_formal_system(source)
+    state = Shard(fs, shard, len(inboxes), inboxes)
+
+    while True:
+        command, args = conn.recv()
+        if command == 'stop':
+            conn.close()
+            return
+        try:
+            conn.send((True, getattr(state, command)(*args)))
+        except Exception as e:
+            conn.send((False, e))
+
+
+class DistributedClosure(object):
+    """Closure computed by steps, partitioned across worker processes.
+
+    >>> fs = FormalSystem()
+    >>> fs.read_formal_system('./definitions/MIU.yaml')
+    >>> with DistributedClosure('./definitions/MIU.yaml', fs.iterate_over_schema(), 2) as dc:
+    ...     dc.extend(3)
+    ...     sorted(dc.frontier())
+    ...     'MIUIU' in dc, 'MU' in dc
+    4
+    ['MIIIIIIII', 'MIIIIU', 'MIIUIIU', 'MIU', 'MIUIUIUIU', 'MUI']
+    (True, False)
+    """
+    def __init__(self, source, ths, n_workers=2):
+        self.source = source
+        self.fs = FormalSystem()
+        self.fs.read_formal_system(source)
+        self.n_workers = n_workers
+        self.generation = 0
+
+        self._conns = []
+        self._procs = []
+        self._inboxes = [multiprocessing.Queue() for _ in range(n_workers)]
+
+        for shard in range(n_workers):
+            conn, child = multiprocessing.Pipe()
+            proc = multiprocessing.Process(target=_serve,
+                                           args=(child, source, shard, self._inboxes))
+            proc.daemon = True
+            proc.start()
+            self._conns.append(conn)
+            self._procs.append(proc)
+
+        batches = [[] for _ in range(n_workers)]
+        for th in ths:
+            shard = shard_of(th.string, n_workers)
+            batches[shard].append((th.string, None, ()))
+            if len(batches[shard]) >= BATCH:
+                self._call(shard, 'receive', batches[shard])
+                batches[shard] = []
+
+        self._broadcast('receive', batches)
+        self._swap()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _call(self, shard, command, *args):
+        self._conns[shard].send((command, args))
+        return self._result(shard)
+
+    def _result(self, shard):
+        ok, result = self._conns[shard].recv()
+        if not ok:
+            raise result
+        return result
+
+    def _broadcast(self, command, *args_per_shard):
+        # All workers run at the same time, we wait for all of them
+        for shard, conn in enumerate(self._conns):
+            conn.send((command, tuple(a[shard] for a in args_per_shard)))
+        results = [conn.recv() for conn in self._conns]
+
+        errors = [result for ok, result in results if not ok]
+        if errors:
+            # The error of the failing shard, not of the aborted ones
+            errors.sort(key=lambda e: isinstance(e, ShardAborted))
+            raise errors[0]
+        return [result for _, result in results]
+
+    def _swap(self):
+        self._broadcast('swap')
+        self.generation += 1
+
+    def extend(self, n_steps=1):
+        """Compute n_steps more generations, return the generation number."""
+        for _ in range(n_steps):
+            # Shards exchange theorems between themselves,
+            # we only wait for all of them to be done
+            self._broadcast('step')
+            self._swap()
+
+        return self.generation
+
+    def frontier(self):
+        """Strings of the current generation, shard by shard."""
+        return [s for g in self._broadcast('generation') for s in g]
+
+    def sizes(self):
+        """Number of distinct theorems per shard."""
+        return self._broadcast('size')
+
+    def __len__(self):
+        return sum(self.sizes())
+
+    def __contains__(self, th):
+        string = str(th)
+        return self._call(shard_of(string, self.n_workers), 'lookup', string) is not None
+
+    def theorem(self, th):
+        """First found theorem for th, with its derivation, or None."""
+        string = str(th)
+        ref = self._call(shard_of(string, self.n_workers), 'lookup', string)
+        if ref is None:
+            return
+
+        rules = dict((r.name, r) for r in self.fs.rules)
+        built = {}
+
+        def build(ref):
+            if ref not in built:
+                string, rule, parents = self._call(ref[0], 'get', ref[1])
+                if rule is None:
+                    built[ref] = Theorem(string)
+                else:
+                    built[ref] = Theorem(string,
+                                         parents=[build(p) for p in parents],
+                                         p_rule=rules[rule])
+            return built[ref]
+
+        return build(ref)
+
+    def derivation(self, th, verbose=False):
+        return self.fs.th_to_derivation(th, self.theorem(th), verbose=verbose)
+
+    def close(self):
+        for conn in self._conns:
+            try:
+                conn.send(('stop', ()))
+            except (IOError, OSError):
+                pass
+        for proc in self._procs:
+            proc.join()
+        for inbox in self._inboxes:
+            inbox.close()
+        self._conns = []
+        self._procs = []
+        self._inboxes = []
@@ -1,14 +1,15 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
-from __future__ import with_statement
+from __future__ import with_statement, print_function
 
 import yaml
 import re
 from itertools import product, repeat, count
 
-from .leplparsing import reg_to_lex, parse
+from .matching import reg_to_pattern, parse, MatchCache
 from .OrderedSet import OrderedSet
+from .rulegraph import RuleGraph
 
 
 def generate_wildcards(conditions):
@@ -27,7 +28,7 @@ def generate_wildcards(conditions):
 def iterate_over_wildcard(wildcards):
     for coords in triangle_iteration(start=1, dim=len(wildcards)):
         w_iter = {}
-        for name, k in zip(wildcards.keys(), coords):
+        for name, k in zip(sorted(wildcards), coords):
             # Case .*? non-greedy matching
             reg = wildcards[name].strip('?')
             s, wildcard = reg[:-1], reg[-1]
@@ -55,7 +56,7 @@ def triangle_iteration(start, dim, stop=None):
     >>> list(triangle_iteration(1, 1, stop=3))
     [(1,), (2,), (3,)]
     >>> list(triangle_iteration(1, 2, stop=3))
-    [(1, 1), (1, 2), (2, 1), (1, 3), (3, 1), (2, 2)]
+    [(1, 1), (1, 2), (2, 1), (1, 3), (2, 2), (3, 1)]
     >>> list(triangle_iteration(1, 0, stop=3))
     []
     """
@@ -64,17 +65,18 @@ def triangle_iteration(start, dim, stop=None):
 
     # Initialization
     point = (start, ) * dim
-    frontier = set([point])
+    frontier = [point]
     yield point
 
     c = 1
 
     while True:
-        frontier = set(
+        # Sorted, so that iteration order does not depend on hashing
+        frontier = sorted(set(
             increase_coord(p, i)
-            for p in list(frontier)
+            for p in frontier
             for i, _ in enumerate(p)
-        )
+        ))
 
         for p in frontier:
             yield p
@@ -98,7 +100,7 @@ def compile_schema(raw_schema):
     raw_schema = raw_schema.split(',')
     conditions, exp = raw_schema[:-1], raw_schema[-1].strip()
     wildcards = generate_wildcards(conditions)
-    (regex,), aliases = reg_to_lex((exp,), wildcards)
+    (regex,), aliases = reg_to_pattern((exp,), wildcards)
     (schema,) = tuple(reg_to_printer((exp,), wildcards))
 
     return wildcards, aliases, regex, schema
@@ -114,14 +116,17 @@ def compile_rule(raw_rule):
 
     wildcards = generate_wildcards(conditions)
 
-    oldts, aliases = reg_to_lex(oldts, wildcards)
+    # Shapes of produced theorems, for the rule dependency analysis
+    shapes, _ = reg_to_pattern(newts, wildcards)
+
+    oldts, aliases = reg_to_pattern(oldts, wildcards)
     newts = tuple(reg_to_printer(newts, wildcards))
 
-    return aliases, oldts, newts
+    return aliases, oldts, newts, shapes
 
 
 def reverse_alias(aliases, alias):
-    for s, s_aliases in aliases.iteritems():
+    for s, s_aliases in aliases.items():
         if alias in s_aliases:
             return s
 
@@ -133,7 +138,7 @@ def check_consistency(aliases, *matches):
     ua_match = {}
 
     for match in matches:
-        for alias, v in match.iteritems():
+        for alias, v in match.items():
             sym = reverse_alias(aliases, alias)
 
             if sym not in ua_match:
@@ -151,6 +156,8 @@ class AxiomsSchema(object):
         self.raw_schema = s
 
         self.wildcards, self.aliases, self.reg, self.schema = compile_schema(s)
+        # Aliases which must match the same value, like in xpx
+        self._same = [a for a in self.aliases.values() if len(a) > 1]
 
     def __str__(self):
         return '(%s) %s' % (self.name, self.raw_schema)
@@ -165,15 +172,19 @@ class AxiomsSchema(object):
             yield check_consistency(self.aliases, m)
 
     def is_axiom(self, theorem, verbose=True):
+        if not verbose:
+            # We stop at the first consistent match
+            return self.reg.first(theorem.string, self._same) is not None
+
         for c in self._is_axiom(theorem):
             if c is None:  # No match or inconsistency in aliases
                 if verbose:
-                    print 'N  %-10s *is not* an axiom [%s]' % \
-                        (theorem, self)
+                    print('N  %-10s *is not* an axiom [%s]' %
+                          (theorem, self))
             else:
                 if verbose:
-                    print 'Y  %-10s   *is*   an axiom [%s with %s]' % \
-                        (theorem, self, ' and '.join('%s=%s' % (s, c[s]) for s in self.aliases))
+                    print('Y  %-10s   *is*   an axiom [%s with %s]' %
+                          (theorem, self, ' and '.join('%s=%s' % (s, c[s]) for s in self.aliases)))
                 return True
         return False
 
@@ -201,6 +212,12 @@ class Theorem(object):
             self.p_rule = 'Axiom'
         else:
             self.p_rule = p_rule
+        # Rewrites ending before this position are out of order
+        self.bound = 0
+        # (shard, index) of the theorem in a DistributedClosure
+        self.ref = None
+        # (writer or file key, record id) of the theorem in a closure file
+        self.record = None
 
     def __str__(self):
         return self.string
@@ -221,37 +238,68 @@ class Rule(object):
     def __init__(self, name, s):
         self.name = name
         self.raw_rule = s
-        self.aliases, self.oldts, self.newts = compile_rule(s)
+        self.aliases, self.oldts, self.newts, self.shapes = compile_rule(s)
 
     def __str__(self):
         return '(%s) %s' % (self.name, self.raw_rule)
 
-    def produce_one(self, t_ths, verbose=True):
+    def match(self, pr, string):
+        """Consistent matches of string for partial rule pr.
+
+        Return (failures, matches), failures being the number
+        of non-matches and inconsistent matches.
+        """
+        failures = 0
+        matches = []
+
+        for m in parse(pr, string):
+            if m is None:
+                # No match
+                failures += 1
+                continue
+
+            c = check_consistency(self.aliases, m)
+
+            if c is None:
+                # Inconsistency in aliases, non-match
+                failures += 1
+                continue
+
+            matches.append(m)
+
+        return failures, matches
+
+    def produce_one(self, t_ths, verbose=True, cache=None, order=None):
         # Note that the 'yield None' are just there
         # inform the upper function that a producing failed
         # It can be commented for speed (about one third gain)
 
+        if order is not None and self in order.rewrites:
+            # Rewrites are matched by position, in canonical order
+            for nth in order.produce(self, t_ths[0]):
+                yield nth
+            return
+
         # We build a list of list of aliases,
         # for each partial rule for each matching possibility
         match_per_cond = []
 
         for pr, t in zip(self.oldts, t_ths):
-            match_per_cond.append([])
-
-            for m in parse(pr, t.string):
-                if m is None:
-                    # No match
-                    yield
-                    continue
-
-                c = check_consistency(self.aliases, m)
-
-                if c is None:
-                    # Inconsistency in aliases, non-match
-                    yield
-                    continue
+            if cache is None:
+                failures, matches = self.match(pr, t.string)
+            else:
+                # Same theorem, same partial rule: same matches
+                key = pr, t.string
+                entry = cache.get(key)
+                if entry is None:
+                    entry = self.match(pr, t.string)
+                    cache.put(key, entry)
+                failures, matches = entry
+
+            for _ in range(failures):
+                yield
 
-                match_per_cond[-1].append(m)
+            match_per_cond.append(matches)
 
         # Cartesian product, we test each possibility of matching
         # in each partial rule
@@ -264,12 +312,22 @@ class Rule(object):
             for nth in self.newts:
                 yield Theorem(nth % c, parents=t_ths, p_rule=self)
 
-    def produce(self, ths, old_ths=None, verbose=True):
+    def produce(self, ths, old_ths=None, verbose=True, graph=None, cache=None, order=None):
         n = len(self.oldts)
 
+        if n == 1:
+            # Each theorem is matched once, nothing to cache
+            cache = None
+
+        if graph is None:
+            accepts = None
+        else:
+            # Theorems are only tried on premises they may match
+            accepts = graph.filter(self)
+
         # Iterate over all possibilities of n-tuple
-        for t_ths in self.compute_combinations(n, ths, old_ths):
-            for nth in self.produce_one(t_ths, verbose):
+        for t_ths in self.compute_combinations(n, ths, old_ths, accepts):
+            for nth in self.produce_one(t_ths, verbose, cache, order):
                 if nth is not None:
                     if verbose:
                         self.display_prod(t_ths, nth)
@@ -280,15 +338,15 @@ class Rule(object):
                         self.display_unprod(t_ths)
 
     def display_prod(self, t_ths, nth):
-        print 'P  %-40s  for  %-25s  gives  %s' % \
-            (self, ' and '.join(str(t) for t in t_ths), nth)
+        print('P  %-40s  for  %-25s  gives  %s' %
+              (self, ' and '.join(str(t) for t in t_ths), nth))
 
     def display_unprod(self, t_ths):
-        print '.  %-40s  for  %-25s' % \
-            (self, ' and '.join(str(t) for t in t_ths))
+        print('.  %-40s  for  %-25s' %
+              (self, ' and '.join(str(t) for t in t_ths)))
 
     @staticmethod
-    def compute_combinations(n, ths, old_ths=None):
+    def compute_combinations(n, ths, old_ths=None, accepts=None):
         if old_ths is None:
             # Here we could just define old_ths as set() and
             # go on, but if ths is OrderedSet, old_ths | ths will fail
@@ -300,8 +358,19 @@ class Rule(object):
         #
         # Note that product will give "same theorem tuple",
         # like (1, 1) as a part of the cartesian product of [1, 2, 3]
-        for t_ths in set(product(*repeat(old_ths | ths, n))) - \
-                set(product(*repeat(old_ths, n))):
+        #
+        # We do not use sets of tuples here, the iteration order
+        # would depend on string hashing, which is randomized in Python 3
+        if accepts is None:
+            pools = repeat(old_ths | ths, n)
+        else:
+            # accepts(k, th) tells if th may be the k-th theorem
+            pools = [[t for t in old_ths | ths if accepts(k, t)]
+                     for k in range(n)]
+
+        for t_ths in product(*pools):
+            if all(t in old_ths for t in t_ths):
+                continue
 
             yield t_ths
 
@@ -318,7 +387,7 @@ def iterator_mix(*iterators):
 
         for it in iterators:
             try:
-                yield it.next()
+                yield next(it)
             except StopIteration:
                 pass
             else:
@@ -339,10 +408,20 @@ class FormalSystem(object):
     def __init__(self):
         self.axioms = []
         self.rules = []
+        # Rule dependency graph, set to None to try all rules on all theorems
+        self.graph = None
+        # Matches of theorems for rules with several premises,
+        # set to None to disable
+        self.cache = MatchCache()
+        # Canonical order of commuting rewrites (see rewriting.RewriteOrder),
+        # None to try all orders
+        self.order = None
+        # Counters of the enumeration (see metrics.Metrics), None to disable
+        self.metrics = None
 
     def read_formal_system(self, source):
         with open(source, 'r') as f:
-            data = yaml.load(f)
+            data = yaml.safe_load(f)
 
             for i, raw_schema in enumerate(data['axioms'], start=1):
                 self.axioms.append(AxiomsSchema(i, raw_schema))
@@ -350,6 +429,8 @@ class FormalSystem(object):
             for i, raw_rule in enumerate(data['rules'], start=1):
                 self.rules.append(Rule(i, raw_rule))
 
+        self.graph = RuleGraph(self.axioms, self.rules)
+
     def is_axiom(self, theorem, verbose=True):
         for axiom in self.axioms:
             if axiom.is_axiom(theorem, verbose):
@@ -368,33 +449,57 @@ class FormalSystem(object):
             yield el
 
     def apply_rules(self, ths, old_ths=None, verbose=True):
+        metrics = self.metrics
         for rule in self.rules:
-            for newt in rule.produce(ths, old_ths, verbose):
+            if metrics is not None:
+                # Rules are listed even when they never fire
+                metrics.fire(rule, 0)
+            for newt in rule.produce(ths, old_ths, verbose, self.graph, self.cache, self.order):
+                if metrics is not None:
+                    # Counted as produced, for progress within a generation
+                    metrics.fire(rule)
                 yield newt
 
-    def _apply_rules_step(self, ths, verbose=True):
+    def collect(self, ths):
+        """OrderedSet of theorems ths, a generation."""
+        if self.order is None:
+            ths = OrderedSet(ths)
+        else:
+            # Duplicates relax the bound of the kept theorem
+            ths = self.order.merge(ths)
+
+        if self.metrics is not None:
+            self.metrics.end_generation(len(ths))
+        return ths
+
+    def _apply_rules_step(self, ths, verbose=True, start=1):
+        # ths is generation start, 1 unless resumed from a saved closure
         current = OrderedSet(ths)
-        yield 1, current
+        yield start, current
 
-        for i in count(2):
+        for i in count(start + 1):
             if verbose:
-                print
-            current = OrderedSet(self.apply_rules(current, verbose=verbose))
+                print()
+            current = self.collect(self.apply_rules(current, verbose=verbose))
             if verbose:
-                print
+                print()
             yield i, current
 
-    def apply_rules_step(self, ths, step, verbose=True):
-        for i, ths in self._apply_rules_step(ths, verbose):
-            print 'STEP %s: %s' % (i, '/'.join(str(b) for b in ths))
+    def apply_rules_step(self, ths, step, verbose=True, writer=None, start=1):
+        for i, ths in self._apply_rules_step(ths, verbose, start):
+            print('STEP %s: %s' % (i, '/'.join(str(b) for b in ths)))
+            if writer is not None:
+                writer.extend(ths, i)
             if i >= step:
                 break
 
         return ths
 
-    def derivation_step(self, axioms, th, step=10, verbose=True):
-        for i, ths in self._apply_rules_step(axioms, verbose):
-            print 'STEP %s: %s' % (i, '/'.join(str(b) for b in ths))
+    def derivation_step(self, axioms, th, step=10, verbose=True, writer=None, start=1):
+        for i, ths in self._apply_rules_step(axioms, verbose, start):
+            print('STEP %s: %s' % (i, '/'.join(str(b) for b in ths)))
+            if writer is not None:
+                writer.extend(ths, i)
             if th in ths or i >= step:
                 break
 
@@ -406,18 +511,21 @@ class FormalSystem(object):
 
         for turn, ax in enumerate(ths, start=1):
             if verbose:
-                print '[Adding %s to bucket]' % ax
-                print
+                print('[Adding %s to bucket]' % ax)
+                print()
 
-            bucket.add(ax)
+            if self.order is None:
+                bucket.add(ax)
+            else:
+                self.order.add(bucket, ax)
             yield turn, bucket
 
             if verbose:
-                print
+                print()
 
             # All permutations of bucket + old_bucket will be computed,
             # minus the permutations of old_bucket
-            new_bucket = OrderedSet(self.apply_rules(bucket, old_bucket, verbose))
+            new_bucket = self.collect(self.apply_rules(bucket, old_bucket, verbose))
 
             if full:
                 # if this case, old_bucket contains all theorems
@@ -432,7 +540,8 @@ class FormalSystem(object):
                                 min_len=None,
                                 max_turns=None,
                                 full=False,
-                                verbose=True):
+                                verbose=True,
+                                writer=None):
 
         if max_turns is None:
             max_turns = float('inf')
@@ -447,8 +556,10 @@ class FormalSystem(object):
         bucket_gen = self._apply_rules_bucket(ths, full, verbose)
 
         for turn, bucket in bucket_gen:
-            print '=== BUCKET %s: %s' % \
-                (turn, '/'.join(str(b) for b in bucket))
+            print('=== BUCKET %s: %s' %
+                  (turn, '/'.join(str(b) for b in bucket)))
+            if writer is not None:
+                writer.extend(bucket, turn)
 
             # We stop if we processed all axioms shorter than min_len
             # And all their "childs" are longer than min_len after some iteration
@@ -463,7 +574,8 @@ class FormalSystem(object):
                        th,
                        max_turns=None,
                        full=False,
-                       verbose=True):
+                       verbose=True,
+                       writer=None):
 
         if max_turns is None:
             max_turns = float('inf')
@@ -471,8 +583,10 @@ class FormalSystem(object):
         bucket_gen = self._apply_rules_bucket(axioms, full, verbose)
 
         for turn, bucket in bucket_gen:
-            print '=== BUCKET %s: %s' % \
-                (turn, '/'.join(str(b) for b in bucket))
+            print('=== BUCKET %s: %s' %
+                  (turn, '/'.join(str(b) for b in bucket)))
+            if writer is not None:
+                writer.extend(bucket, turn)
 
             if th in bucket or turn >= max_turns:
                 break
@@ -483,11 +597,11 @@ class FormalSystem(object):
     def th_to_derivation(th, fth, verbose):
         if fth is None:
             if verbose:
-                print '\n=== Theorem %s not found' % th
+                print('\n=== Theorem %s not found' % th)
             return
 
         if verbose:
-            print '\n=== Theorem %s found, derivation:' % th
+            print('\n=== Theorem %s found, derivation:' % th)
 
         gen = 0
         report = [(gen, fth)]
@@ -514,11 +628,11 @@ class FormalSystem(object):
         if verbose:
             for gen, p in report:
                 if p.parents:
-                    print '[%-2s]  %-40s  for  %-25s  gives  %-20s' % \
-                        (f_gen - gen, p.p_rule, ' and '.join(str(t) for t in p.parents), p)
+                    print('[%-2s]  %-40s  for  %-25s  gives  %-20s' %
+                          (f_gen - gen, p.p_rule, ' and '.join(str(t) for t in p.parents), p))
                 else:
-                    print '[%-2s]  %-40s       %-25s  gives  %-20s' % \
-                        (f_gen - gen, p.p_rule, '', p)
+                    print('[%-2s]  %-40s       %-25s  gives  %-20s' %
+                          (f_gen - gen, p.p_rule, '', p))
 
         return report
 
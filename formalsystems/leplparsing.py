@@ -1,11 +1,23 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
+"""
+LEPL based matcher.
+
+LEPL is optional, the engine uses the built-in matcher
+from the matching module, with the same interface.
+"""
+
 import operator
 from collections import defaultdict
+from functools import reduce
 
-from lepl import *  # noqa
-import lepl
+try:
+    from lepl import Any, Eos, Literal, make_dict
+    import lepl
+except ImportError:
+    # LEPL is not installed, or does not support this interpreter
+    lepl = None
 
 
 def reg_to_lex(conditions, wildcards):
@@ -18,6 +30,9 @@ def reg_to_lex(conditions, wildcards):
     Any() > 'x_0' & 'M' & Any() > 'x_1', and we chech that the matched values
     for all aliases like x_0, x_1 are the same.
     """
+    if lepl is None:
+        raise ImportError('LEPL is not available, use the matching module')
+
     aliases = defaultdict(set)
     n_conds = []
 
@@ -46,6 +61,7 @@ def reg_to_lex(conditions, wildcards):
 def join(args):
     return ''.join(args)
 
+
 def make_token(alias, reg):
     if reg[-1] in '*+':
         s, wildcard = reg[:-1], reg[-1]
@@ -0,0 +1,309 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Built-in matcher, a pure Python replacement for the LEPL parsers.
+
+Patterns are compiled from the same conditions and wildcards
+definitions as in leplparsing, and parse yields the same matches,
+in the same order (greedy, depth first).
+
+Matches are enumerated as positions: a wildcard followed by plain
+characters is only tried where str.find finds them, and values
+are only sliced from the string when a match is requested.
+"""
+
+from collections import defaultdict, OrderedDict
+
+
+class Pattern(object):
+    """Compiled condition, a sequence of tokens.
+
+    Each token is a tuple (alias, unit, rep):
+
+    - alias is the name under which the matched value is captured,
+      or None for plain characters
+    - unit is the repeated string, or None for any character
+    - rep is the minimal number of repetitions,
+      or None if unit must be matched exactly once
+
+    >>> (p,), _ = reg_to_pattern(('xIIIy',), {'x': '.*', 'y': '.*'})
+    >>> list(p.spans('MIIIIU'))
+    [(('x_0', 0, 2), ('y_0', 5, 6)), (('x_0', 0, 1), ('y_0', 4, 6))]
+    >>> sorted(p.first('MIIIIU').items())
+    [('x_0', 'MI'), ('y_0', 'U')]
+    >>> p.matches('MIIU'), p.first('MIIU')
+    (False, None)
+    """
+    def __init__(self, tokens):
+        self.tokens = tuple(tokens)
+
+        # Consecutive plain characters are merged, to be found at once
+        items = []
+        for alias, unit, rep in self.tokens:
+            if alias is None and rep is None and items and items[-1][0] is None and items[-1][2] is None:
+                items[-1] = None, items[-1][1] + unit, None
+            else:
+                items.append((alias, unit, rep))
+        self._items = tuple(items)
+
+        last = items[-1] if items else None
+        if last is not None and last[2] is None:
+            self._suffix = last[1]
+        else:
+            self._suffix = ''
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self.tokens)
+
+    def spans(self, string):
+        """Yield matches lazily, as tuples of (alias, start, end)."""
+        if not string.endswith(self._suffix):
+            return iter(())
+        return _spans(self._items, 0, string, 0, [])
+
+    def match_all(self, string):
+        """Yield matches, as dicts alias -> value."""
+        for spans in self.spans(string):
+            yield dict((alias, string[start:end]) for alias, start, end in spans)
+
+    def first(self, string, same=()):
+        """First match, or None.
+
+        same holds groups of aliases which must match the same value,
+        their spans are compared before building the match.
+        """
+        for spans in self.spans(string):
+            if same and not _same_values(string, spans, same):
+                continue
+            return dict((alias, string[start:end]) for alias, start, end in spans)
+
+    def matches(self, string):
+        """Test if string matches, stopping at the first match."""
+        for _ in self.spans(string):
+            return True
+        return False
+
+
+def make_token(alias, reg):
+    """Transform a wildcard regular expression into a token.
+
+    >>> make_token('x_0', '.*')
+    ('x_0', None, 0)
+    >>> make_token('x_0', '-+')
+    ('x_0', '-', 1)
+    >>> make_token('x_0', 'MI')
+    ('x_0', 'MI', None)
+    """
+    if reg[-1] in '*+':
+        s, wildcard = reg[:-1], reg[-1]
+        if wildcard == '+':
+            rep = 1
+        else:  # wildcard is *
+            rep = 0
+        if s == '.':
+            return alias, None, rep
+        return alias, s, rep
+
+    return alias, reg, None
+
+
+def reg_to_pattern(conditions, wildcards):
+    """Transform a regular expression into a Pattern object.
+
+    Same as leplparsing.reg_to_lex, aliases are created
+    for multiple same wildcards, like xMx.
+
+    >>> (p,), aliases = reg_to_pattern(('xMx',), {'x': '-+'})
+    >>> p
+    Pattern((('x_0', '-', 1), (None, 'M', None), ('x_1', '-', 1)))
+    >>> sorted(aliases['x'])
+    ['x_0', 'x_1']
+    """
+    aliases = defaultdict(set)
+    patterns = []
+
+    # All conditions
+    for cond in conditions:
+        tokens = []
+
+        for char in cond:
+            if char in wildcards:
+                alias = '%s_%s' % (char, len(aliases[char]))
+                aliases[char].add(alias)
+                tokens.append(make_token(alias, reg=wildcards[char]))
+            else:
+                tokens.append((None, char, None))
+
+        patterns.append(Pattern(tokens))
+
+    return tuple(patterns), aliases
+
+
+def _ends(string, literal, low, high, pos, size):
+    # Positions of literal in [low, high], from right to left,
+    # in steps of size from pos
+    end = string.rfind(literal, low, high + len(literal))
+    while end != -1:
+        if (end - pos) % size == 0:
+            yield end
+        end = string.rfind(literal, low, end - 1 + len(literal))
+
+
+def _same_values(string, spans, same):
+    # Test if the aliases of each group span equal substrings
+    where = dict((alias, (start, end)) for alias, start, end in spans)
+
+    for group in same:
+        group = iter(group)
+        start, end = where[next(group)]
+        for alias in group:
+            s, e = where[alias]
+            if e - s != end - start or string[s:e] != string[start:end]:
+                return False
+    return True
+
+
+def _spans(items, i, string, pos, spans):
+    if i == len(items):
+        if pos == len(string):
+            yield tuple(spans)
+        return
+
+    alias, unit, rep = items[i]
+
+    if rep is None:
+        # Exact match
+        if string.startswith(unit, pos):
+            if alias is None:
+                for m in _spans(items, i + 1, string, pos + len(unit), spans):
+                    yield m
+                return
+            spans.append((alias, pos, pos + len(unit)))
+            for m in _spans(items, i + 1, string, pos + len(unit), spans):
+                yield m
+            spans.pop()
+        return
+
+    # Repetition, we find the longest run, then backtrack
+    if unit is None:
+        size = 1
+        high = len(string)
+    else:
+        size = len(unit)
+        if size == 1:
+            high = len(string) - len(string[pos:].lstrip(unit))
+        else:
+            high = pos
+            while string.startswith(unit, high):
+                high += size
+
+    low = pos + rep * size
+    if high < low:
+        return
+
+    if i + 1 == len(items):
+        # Last token, it must run until the end, only the longest can
+        ends = [high] if high == len(string) else []
+    elif items[i + 1][2] is None:
+        # Next token is plain, we only try where it is found
+        after = items[i + 1][1]
+        if i + 2 == len(items):
+            # and it ends the string
+            end = len(string) - len(after)
+            ends = [end] if low <= end <= high and (end - pos) % size == 0 else []
+        else:
+            ends = _ends(string, after, low, high, pos, size)
+    else:
+        ends = range(high, low - 1, -size)
+
+    for end in ends:
+        spans.append((alias, pos, end))
+        for m in _spans(items, i + 1, string, end, spans):
+            yield m
+        spans.pop()
+
+
+def parse(pattern, theorem):
+    """Yield all matches of theorem, as dicts alias -> value.
+
+    Like leplparsing.parse, a single None is yielded if nothing matched.
+
+    >>> (p,), _ = reg_to_pattern(('xIIIy',), {'x': '.*', 'y': '.*'})
+    >>> [sorted(m.items()) for m in parse(p, 'MIIII')]
+    [[('x_0', 'MI'), ('y_0', '')], [('x_0', 'M'), ('y_0', 'I')]]
+    >>> list(parse(p, 'MUI'))
+    [None]
+    """
+    matched = False
+
+    for m in pattern.match_all(theorem):
+        matched = True
+        yield m
+
+    if not matched:
+        # No match
+        yield
+
+
+class MatchCache(object):
+    """Bounded LRU cache for matches, keyed by (pattern, theorem string).
+
+    Values are opaque to the cache. Counters tell how useful it is.
+
+    >>> cache = MatchCache(maxsize=2)
+    >>> cache.put('a', 1)
+    >>> cache.put('b', 2)
+    >>> cache.get('a')
+    1
+    >>> cache.put('c', 3)
+    >>> cache.get('b') is None
+    True
+    >>> cache
+    MatchCache(size=2, maxsize=2, hits=1, misses=1, evictions=1)
+    >>> cache.hit_rate
+    0.5
+    """
+    def __init__(self, maxsize=100000):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __repr__(self):
+        return '%s(size=%s, maxsize=%s, hits=%s, misses=%s, evictions=%s)' % \
+            (self.__class__.__name__, len(self), self.maxsize,
+             self.hits, self.misses, self.evictions)
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return float(self.hits) / total if total else 0.0
+
+    def get(self, key):
+        try:
+            # Most recently used go last
+            value = self._data.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+
+        self._data[key] = value
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self._data.pop(key, None)
+        self._data[key] = value
+
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        self._data.clear()
+        self.hits = self.misses = self.evictions = 0
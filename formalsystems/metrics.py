@@ -0,0 +1,236 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Low overhead metrics for long running enumerations.
+
+Counters are updated as theorems are produced, with one increment
+each, which costs little compared to the matching. A sample is taken
+at the end of each generation, and kept in a ring buffer.
+
+Counters may be watched with a progress line printed on a timer,
+or exported in Prometheus text format from a local HTTP endpoint.
+"""
+
+from __future__ import absolute_import, print_function
+
+import os
+import sys
+import time
+import threading
+from collections import defaultdict, deque, namedtuple
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:  # Python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+try:
+    import resource
+except ImportError:  # Not on Windows
+    resource = None
+
+
+Sample = namedtuple('Sample', ['generation', 'time', 'theorems', 'duplicates',
+                               'firings', 'throughput', 'rss'])
+
+
+def rss():
+    """Resident set size of the process in bytes, or None if unknown."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, AttributeError):
+        pass
+
+    if resource is None:
+        return None
+
+    # Peak size, in kilobytes on Linux and bytes on Mac OS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def _human(n):
+    for unit in ('', 'k', 'M', 'G'):
+        if abs(n) < 1000:
+            return '%.0f%s' % (n, unit) if unit == '' else '%.1f%s' % (n, unit)
+        n /= 1000.0
+    return '%.1fT' % n
+
+
+class Metrics(object):
+    """Counters of an enumeration, set as FormalSystem.metrics.
+
+    - theorems and duplicates are summed over generations
+    - firings counts theorems produced by each rule (by name)
+    - produced counts theorems produced in the current generation
+    - history is a ring buffer of the last size samples
+
+    >>> from formalsystems.formalsystems import FormalSystem
+    >>> fs = FormalSystem()
+    >>> fs.read_formal_system('./definitions/MIU.yaml')
+    >>> fs.metrics = Metrics()
+    >>> r = fs.apply_rules_step(fs.iterate_over_schema(), 4, verbose=False)
+    STEP 1: MI
+    STEP 2: MIU/MII
+    STEP 3: MIIU/MIUIU/MIIII
+    STEP 4: MIIIIU/MIIUIIU/MIUIUIUIU/MIIIIIIII/MIU/MUI
+    >>> m = fs.metrics
+    >>> m.generation, m.theorems, m.duplicates, sorted(m.firings.items())
+    (4, 11, 0, [(1, 3), (2, 6), (3, 2), (4, 0)])
+    >>> [s.theorems for s in m.history]
+    [2, 3, 6]
+    >>> m.produced
+    0
+    """
+    def __init__(self, size=1000):
+        self.history = deque(maxlen=size)
+        self.generation = 1
+        self.theorems = 0
+        self.duplicates = 0
+        self.firings = defaultdict(int)
+        self.start = time.time()
+
+        self.produced = 0
+        self._last = self.start
+
+    def fire(self, rule, n=1):
+        """Count n theorems produced by rule."""
+        self.firings[rule.name] += n
+        self.produced += n
+
+    def end_generation(self, size):
+        """Close a generation of size distinct theorems, and sample."""
+        now = time.time()
+        elapsed = now - self._last
+
+        self.generation += 1
+        self.theorems += size
+        duplicates = max(0, self.produced - size)
+        self.duplicates += duplicates
+
+        self.history.append(Sample(generation=self.generation,
+                                   time=now,
+                                   theorems=size,
+                                   duplicates=duplicates,
+                                   firings=self.produced,
+                                   throughput=size / elapsed if elapsed > 0 else 0.0,
+                                   rss=rss()))
+        self.produced = 0
+        self._last = now
+
+    @property
+    def throughput(self):
+        """Theorems per second, over the last generation."""
+        return self.history[-1].throughput if self.history else 0.0
+
+    def line(self):
+        """Compact progress line."""
+        current = rss()
+        return 'gen %d | %s theorems | %s dup | %s firings | %s produced | %s th/s | %s | %.0fs' % (
+            self.generation,
+            _human(self.theorems),
+            _human(self.duplicates),
+            _human(sum(self.firings.values())),
+            _human(self.produced),
+            _human(self.throughput),
+            'rss ?' if current is None else 'rss %sB' % _human(current),
+            time.time() - self.start)
+
+    def prometheus(self, prefix='formalsystems'):
+        """Counters in Prometheus text exposition format."""
+        lines = []
+
+        def metric(name, kind, doc, values):
+            lines.append('# HELP %s_%s %s' % (prefix, name, doc))
+            lines.append('# TYPE %s_%s %s' % (prefix, name, kind))
+            for labels, value in values:
+                lines.append('%s_%s%s %s' % (prefix, name, labels, value))
+
+        metric('generation', 'gauge', 'Current generation.',
+               [('', self.generation)])
+        metric('theorems_total', 'counter', 'Distinct theorems, summed over generations.',
+               [('', self.theorems)])
+        metric('duplicates_total', 'counter', 'Theorems produced again in a generation.',
+               [('', self.duplicates)])
+        metric('rule_firings_total', 'counter', 'Theorems produced by each rule.',
+               [('{rule="%s"}' % name, n) for name, n in sorted(self.firings.items())])
+        metric('produced', 'gauge', 'Theorems produced in the current generation.',
+               [('', self.produced)])
+        metric('throughput', 'gauge', 'Theorems per second, over the last generation.',
+               [('', '%.3f' % self.throughput)])
+
+        current = rss()
+        if current is not None:
+            metric('rss_bytes', 'gauge', 'Resident set size.', [('', current)])
+
+        return '\n'.join(lines) + '\n'
+
+
+class Progress(object):
+    """Print the progress line of metrics every interval seconds,
+    from a background thread.
+    """
+    def __init__(self, metrics, interval=5.0, stream=None):
+        self.metrics = metrics
+        self.interval = interval
+        self.stream = sys.stderr if stream is None else stream
+
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _run(self):
+        while True:
+            self._stop.wait(self.interval)
+            if self._stop.is_set():
+                return
+            print(self.metrics.line(), file=self.stream)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+
+        body = self.server.metrics.prometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        # No logging on each scrape
+        pass
+
+
+def serve(metrics, port=9100, host='127.0.0.1'):
+    """Export metrics on http://host:port/metrics, from a background thread.
+
+    Return the server, call shutdown() to stop it.
+    Port 0 picks a free port, see server.server_address.
+    """
+    server = HTTPServer((host, port), _Handler)
+    server.metrics = metrics
+
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
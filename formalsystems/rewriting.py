@@ -0,0 +1,174 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Canonical order of commuting rewrites.
+
+Some rules only rewrite a literal infix, whatever the context,
+like xIIIy => xUy in MIU. Two such rewrites on disjoint parts of a
+theorem commute: applied in any order, they give the same theorem.
+The step algorithm would find this theorem twice, by both orders.
+
+We only keep the left to right order: after a rewrite whose output
+starts at position p, a rewrite ending strictly before p is skipped.
+Each theorem remembers this bound; when a theorem is produced several
+times in a generation, it keeps the lowest bound, so no theorem is lost.
+Other rules (like Mx => Mxx) reset the bound.
+
+This is only sound when each rule has a single premise: derivations
+are then sequences of rewrites, which may be reordered.
+"""
+
+from __future__ import absolute_import
+
+from .OrderedSet import OrderedSet
+from .formalsystems import Theorem, reverse_alias
+
+
+def _is_context(token):
+    # Wildcard matching anything, like x is .*
+    alias, unit, rep = token
+    return alias is not None and unit is None and rep == 0
+
+
+def rewrite_of(rule):
+    """Describe rule as a rewrite of a literal infix in any context.
+
+    Return (left context symbol, right context symbol, infix),
+    symbols being None if there is no context on this side,
+    or None if rule is not such a rewrite.
+
+    >>> from formalsystems.formalsystems import Rule
+    >>> rewrite_of(Rule(1, 'x y are .*, xIIIy => xUy'))
+    ('x', 'y', 'III')
+    >>> rewrite_of(Rule(1, 'x is .*, xI => xIU'))
+    ('x', None, 'I')
+    >>> rewrite_of(Rule(1, 'x is .*, Mx => Mxx')) is None
+    True
+    >>> rewrite_of(Rule(1, 'x is -+, xI => xIU')) is None
+    True
+    """
+    if len(rule.oldts) != 1 or len(rule.newts) != 1:
+        return
+
+    tokens = list(rule.oldts[0].tokens)
+    template = rule.newts[0]
+
+    symbols = []
+    for side in (0, -1):
+        if tokens and _is_context(tokens[side]):
+            symbols.append(reverse_alias(rule.aliases, tokens[side][0]))
+            tokens.pop(side)
+        else:
+            symbols.append(None)
+    left, right = symbols
+
+    if left is not None and left == right:
+        return
+
+    # The infix must be literal, and the context used once
+    if any(alias is not None for alias, _, _ in tokens):
+        return
+    if any(len(rule.aliases[s]) != 1 for s in (left, right) if s is not None):
+        return
+
+    prefix = '' if left is None else '%%(%s)s' % left
+    suffix = '' if right is None else '%%(%s)s' % right
+
+    if not (template.startswith(prefix) and template.endswith(suffix)):
+        return
+    if len(template) < len(prefix) + len(suffix):
+        return
+    if '%' in template[len(prefix):len(template) - len(suffix)]:
+        return
+
+    return left, right, ''.join(unit for _, unit, _ in tokens)
+
+
+class RewriteOrder(object):
+    """Skip rewrites commuting with the previous one, out of order.
+
+    >>> from formalsystems.formalsystems import FormalSystem
+    >>> fs = FormalSystem()
+    >>> fs.read_formal_system('./definitions/MIU.yaml')
+    >>> order = RewriteOrder(fs.rules)
+    >>> sorted(r.name for r in order.rewrites)
+    [1, 3, 4]
+    """
+    def __init__(self, rules):
+        rules = list(rules)
+
+        if any(len(rule.oldts) > 1 for rule in rules):
+            raise ValueError('Rewrites may only be reordered with rules of one premise')
+
+        # rule -> (left context symbol, right context symbol, infix)
+        self.rewrites = {}
+        for rule in rules:
+            rewrite = rewrite_of(rule)
+            if rewrite is not None:
+                self.rewrites[rule] = rewrite
+
+    def positions(self, rule, th):
+        """Positions where rule may rewrite th, from right to left,
+        skipping the ones out of order.
+        """
+        left, right, infix = self.rewrites[rule]
+        string = th.string
+        start = max(0, th.bound - len(infix))
+
+        if left is None and right is None:
+            found = [0] if string == infix else []
+        elif left is None:
+            found = [0] if string.startswith(infix) else []
+        elif right is None:
+            found = [len(string) - len(infix)] if string.endswith(infix) else []
+        else:
+            found = []
+            i = string.find(infix, start)
+            while i != -1:
+                found.append(i)
+                i = string.find(infix, i + 1)
+
+        return [i for i in reversed(found) if i >= start]
+
+    def produce(self, rule, th):
+        """Theorems produced by the rewrite rule on th, in canonical order.
+
+        Like Rule.produce_one, but matches are found by position.
+        """
+        left, right, infix = self.rewrites[rule]
+        string = th.string
+        positions = self.positions(rule, th)
+
+        if not positions:
+            # No match, or only out of order ones
+            yield
+            return
+
+        (template,) = rule.newts
+
+        for i in positions:
+            c = {}
+            if left is not None:
+                c[left] = string[:i]
+            if right is not None:
+                c[right] = string[i + len(infix):]
+
+            nth = Theorem(template % c, parents=(th,), p_rule=rule)
+            # Rewrites ending before this one are out of order
+            nth.bound = i
+            yield nth
+
+    def add(self, ths, th):
+        """Add th to the OrderedSet ths, keeping the lowest bound."""
+        kept = ths.get(th)
+        if kept is None:
+            ths.add(th)
+        elif th.bound < kept.bound:
+            kept.bound = th.bound
+
+    def merge(self, ths):
+        merged = OrderedSet()
+        for th in ths:
+            self.add(merged, th)
+        return merged
@@ -0,0 +1,184 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Static rule dependency analysis.
+
+A rule produces theorems shaped like its templates (xIU for xI => xIU),
+where each wildcard stands for its regular expression. If no such
+theorem can match the premise of another rule, it is useless to try.
+The analysis only looks at the shapes, so it is conservative:
+it never drops a theorem a rule could actually use.
+"""
+
+from __future__ import absolute_import
+
+from collections import defaultdict
+
+
+def _nfa(pattern):
+    """Build a non deterministic automaton for a pattern.
+
+    Return the transitions as a list of [(label, target)] per state,
+    the last state being the accepting one. label is a character,
+    or None for any character.
+    """
+    transitions = [[]]
+
+    def chain(unit, start):
+        # Consume unit from start, return the state we end in
+        state = start
+        for c in unit:
+            transitions.append([])
+            transitions[state].append((c, len(transitions) - 1))
+            state = len(transitions) - 1
+        return state
+
+    state = 0
+
+    for _, unit, rep in pattern.tokens:
+        if unit is None:
+            unit = (None,)
+
+        if rep is None:
+            state = chain(unit, state)
+            continue
+
+        for _ in range(rep):
+            state = chain(unit, state)
+
+        # Loop on unit, back to the current state
+        loop = state
+        for c in unit[:-1]:
+            transitions.append([])
+            transitions[loop].append((c, len(transitions) - 1))
+            loop = len(transitions) - 1
+        transitions[loop].append((unit[-1], state))
+
+    return transitions, state
+
+
+def _compatible(a, b):
+    return a is None or b is None or a == b
+
+
+def patterns_intersect(p1, p2):
+    """Test if some string matches both patterns.
+
+    Equality constraints between aliases are ignored.
+
+    >>> from formalsystems.matching import reg_to_pattern
+    >>> (p1, p2, p3), _ = reg_to_pattern(('xNDPxy', '--NDPz', 'zSD--'),
+    ...                                  {'x': '-+', 'y': '-+', 'z': '-+'})
+    >>> patterns_intersect(p1, p2), patterns_intersect(p3, p2)
+    (True, False)
+    """
+    t1, acc1 = _nfa(p1)
+    t2, acc2 = _nfa(p2)
+
+    seen = set([(0, 0)])
+    stack = [(0, 0)]
+
+    while stack:
+        s1, s2 = stack.pop()
+        if s1 == acc1 and s2 == acc2:
+            return True
+
+        for l1, n1 in t1[s1]:
+            for l2, n2 in t2[s2]:
+                if _compatible(l1, l2) and (n1, n2) not in seen:
+                    seen.add((n1, n2))
+                    stack.append((n1, n2))
+
+    return False
+
+
+class RuleGraph(object):
+    """Which producers (axioms or rules) may feed each rule premise.
+
+    >>> from formalsystems.formalsystems import FormalSystem
+    >>> fs = FormalSystem()
+    >>> fs.read_formal_system('./definitions/NDP.yaml')
+    >>> rule = fs.rules[2]
+    >>> for p in sorted(str(p) for p in fs.graph.producers(rule, 0)):
+    ...     print(p)
+    (2) z is -+, --NDPz => zSD--
+    (3) x z are -+, zSDx and x-NDPz => zSDx-
+    >>> for p in sorted(str(p) for p in fs.graph.producers(rule, 1)):
+    ...     print(p)
+    (1) x y are -+, xNDPy => xNDPxy
+    (1) x y are -+, xyNDPx
+    """
+    def __init__(self, axioms, rules):
+        self.axioms = list(axioms)
+        self.rules = list(rules)
+        self._rule_set = set(self.rules)
+
+        # (rule, k) -> set of producing rules
+        self._producers = defaultdict(set)
+        self._edges = []
+
+        for axiom in self.axioms:
+            self._link(axiom, (axiom.reg,))
+
+        for producer in self.rules:
+            self._link(producer, producer.shapes)
+
+    def _link(self, producer, shapes):
+        for rule in self.rules:
+            for k, premise in enumerate(rule.oldts):
+                if any(patterns_intersect(s, premise) for s in shapes):
+                    self._producers[rule, k].add(producer)
+                    self._edges.append((producer, rule, k))
+
+    def edges(self):
+        """Iterate over (producer, rule, k), k being the premise index."""
+        return iter(self._edges)
+
+    def producers(self, rule, k):
+        """Axioms and rules which may produce a theorem for premise k of rule."""
+        return frozenset(self._producers[rule, k])
+
+    def filter(self, rule):
+        """Function accepts(k, th) for rule, or None if it would accept all."""
+        producers = [self._producers[rule, k] for k, _ in enumerate(rule.oldts)]
+
+        if all(self._rule_set <= p for p in producers):
+            # Every rule may feed every premise, nothing to filter
+            return None
+
+        def accepts(k, th):
+            # Theorems not produced by a rule of this graph (axioms,
+            # or theorems given as starting points) are always accepted
+            return th.p_rule not in self._rule_set or th.p_rule in producers[k]
+
+        return accepts
+
+    def to_dot(self, name='rules'):
+        """Graphviz representation of the graph.
+
+        Axioms are boxes, rules are ellipses, and edges are labelled
+        with the premise index for rules with several premises.
+        """
+        def quote(s):
+            return '"%s"' % str(s).replace('\\', '\\\\').replace('"', '\\"')
+
+        def node(p):
+            return '%s%s' % ('r' if p in self._rule_set else 'a', p.name)
+
+        lines = ['digraph %s {' % quote(name)]
+
+        for axiom in self.axioms:
+            lines.append('    %s [label=%s, shape=box];' % (node(axiom), quote(axiom)))
+        for rule in self.rules:
+            lines.append('    %s [label=%s];' % (node(rule), quote(rule)))
+
+        for producer, rule, k in self._edges:
+            if len(rule.oldts) > 1:
+                lines.append('    %s -> %s [label=%s];' %
+                             (node(producer), node(rule), quote(k + 1)))
+            else:
+                lines.append('    %s -> %s;' % (node(producer), node(rule)))
+
+        lines.append('}')
+        return '\n'.join(lines)
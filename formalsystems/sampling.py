@@ -0,0 +1,309 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Random walk theorem generation.
+
+When the closure is too big to compute, we may still sample it:
+each walk starts from an axiom, and applies random rules for
+a random number of steps. Only the theorems emitted so far are
+kept in memory (for deduplication), and each theorem carries its
+derivation, like the ones produced by the step or bucket algorithms.
+"""
+
+from __future__ import absolute_import
+
+import random
+import multiprocessing
+from itertools import count, product
+
+from .formalsystems import FormalSystem, Theorem, check_consistency
+
+
+class UniformDepth(object):
+    """Walk depths uniformly distributed in [low, high]."""
+    def __init__(self, low, high):
+        self.low = low
+        self.high = high
+
+    def __call__(self, rng):
+        return rng.randint(self.low, self.high)
+
+
+class GeometricDepth(object):
+    """Walk depths geometrically distributed, with probability p
+    to stop after each step, capped to high.
+    """
+    def __init__(self, p, high):
+        self.p = p
+        self.high = high
+
+    def __call__(self, rng):
+        d = 1
+        while d < self.high and rng.random() > self.p:
+            d += 1
+        return d
+
+
+class Sampler(object):
+    """Random walks over derivations.
+
+    - depth is a number of steps, or a function rng -> number of steps
+    - n_axioms is the number of axioms taken from the schema to start walks
+    - pool_size is the number of emitted theorems kept (reservoir sampling)
+      to fill the other premises of rules with several premises
+
+    >>> fs = FormalSystem()
+    >>> fs.read_formal_system('./definitions/MIU.yaml')
+    >>> s = Sampler(fs, seed=1, depth=UniformDepth(1, 6))
+    >>> ths = list(s.sample(5))
+    >>> len(ths), len(set(str(t) for t in ths))
+    (5, 5)
+    >>> s = Sampler(fs, seed=1, depth=UniformDepth(1, 6))
+    >>> [str(t) for t in s.sample(5)] == [str(t) for t in ths]
+    True
+    """
+    def __init__(self, fs, seed=None, depth=10, n_axioms=100, pool_size=1000):
+        self.fs = fs
+        self.rng = random.Random(seed)
+        self.depth = depth
+        self.axioms = list(fs.iterate_over_schema(max_iter=n_axioms))
+        self.pool_size = pool_size
+        self.pool = []
+        self.emitted = 0
+
+        if not self.axioms:
+            raise ValueError('No axioms to start random walks from')
+
+        # Premises of rules with several premises, other premises
+        # are picked among the walk, the pool and the axioms
+        self._premises = [(rule, k)
+                          for rule in fs.rules if len(rule.oldts) > 1
+                          for k, _ in enumerate(rule.oldts)]
+        self._axiom_entries = [self._entry(th) for th in self.axioms]
+
+    def reset(self, seed=None):
+        """Reseed, and forget emitted theorems."""
+        self.rng.seed(seed)
+        self.pool = []
+        self.emitted = 0
+
+    def _entry(self, th):
+        # We compute once which premises th matches
+        return th, frozenset((rule, k) for rule, k in self._premises
+                             if rule.oldts[k].matches(th.string))
+
+    def _depth(self):
+        if callable(self.depth):
+            return self.depth(self.rng)
+        return self.depth
+
+    def _remember(self, th):
+        # Reservoir sampling over all emitted theorems
+        self.emitted += 1
+        if len(self.pool) < self.pool_size:
+            self.pool.append(self._entry(th))
+        else:
+            k = self.rng.randrange(self.emitted)
+            if k < self.pool_size:
+                self.pool[k] = self._entry(th)
+
+    def _candidates(self, rule, k, history):
+        # Theorems from the walk, the pool and the axioms matching premise k
+        return [t for entries in (history, self.pool, self._axiom_entries)
+                for t, keys in entries if (rule, k) in keys]
+
+    def produce(self, rule, t_ths):
+        """Random theorem produced by rule from t_ths, or None.
+
+        Like Rule.produce_one, but matches are kept as spans and tried
+        in random order: only the first consistent one is sliced.
+        """
+        spans_per_cond = []
+
+        for pr, t in zip(rule.oldts, t_ths):
+            spans = list(pr.spans(t.string))
+            if not spans:
+                return
+            self.rng.shuffle(spans)
+            spans_per_cond.append(spans)
+
+        for t_spans in product(*spans_per_cond):
+            c = check_consistency(rule.aliases,
+                                  *[dict((alias, t.string[start:end])
+                                         for alias, start, end in spans)
+                                    for t, spans in zip(t_ths, t_spans)])
+            if c is not None:
+                nth = self.rng.choice(rule.newts)
+                return Theorem(nth % c, parents=t_ths, p_rule=rule)
+
+    def step(self, th, history, tries=3):
+        """Apply a random rule to th, return the new theorem or None."""
+        rules = list(self.fs.rules)
+        self.rng.shuffle(rules)
+
+        for rule in rules:
+            n = len(rule.oldts)
+            k = self.rng.randrange(n)
+
+            for _ in range(tries if n > 1 else 1):
+                t_ths = []
+                for i in range(n):
+                    if i == k:
+                        t_ths.append(th)
+                        continue
+                    candidates = self._candidates(rule, i, history)
+                    if not candidates:
+                        break
+                    t_ths.append(self.rng.choice(candidates))
+                else:
+                    nth = self.produce(rule, tuple(t_ths))
+                    if nth is not None:
+                        return nth
+
+    def walk(self, depth=None):
+        """Random derivation from a random axiom, return the last theorem.
+
+        The walk stops early if no rule applies.
+        """
+        if depth is None:
+            depth = self._depth()
+
+        th = self.rng.choice(self.axioms)
+        history = [self._entry(th)]
+
+        for _ in range(depth):
+            nth = self.step(th, history)
+            if nth is None:
+                break
+            history.append(self._entry(nth))
+            th = nth
+
+        return th
+
+    def sample(self, n, dedup=True, max_walks=None):
+        """Yield n theorems, ends of random walks.
+
+        We stop after max_walks walks (10 * n by default)
+        if there are not enough distinct theorems.
+        """
+        if max_walks is None:
+            max_walks = 10 * n
+
+        seen = set()
+        emitted = 0
+
+        for _ in range(max_walks):
+            if emitted >= n:
+                return
+
+            th = self.walk()
+            if dedup:
+                if th.string in seen:
+                    continue
+                seen.add(th.string)
+
+            self._remember(th)
+            emitted += 1
+            yield th
+
+
+def flatten(th):
+    """Derivation as plain data: a tuple of (string, rule name, parents),
+    parents being indexes in the tuple, the theorem being last.
+    """
+    nodes = []
+    index = {}
+
+    def visit(t):
+        if id(t) not in index:
+            parents = tuple(visit(p) for p in t.parents)
+            rule = t.p_rule.name if t.parents else None
+            nodes.append((t.string, rule, parents))
+            index[id(t)] = len(nodes) - 1
+        return index[id(t)]
+
+    visit(th)
+    return tuple(nodes)
+
+
+def unflatten(nodes, rules):
+    """Rebuild the theorem from flatten output, with rules of a formal system."""
+    by_name = dict((r.name, r) for r in rules)
+    ths = []
+
+    for string, rule, parents in nodes:
+        if rule is None:
+            ths.append(Theorem(string))
+        else:
+            ths.append(Theorem(string,
+                               parents=[ths[p] for p in parents],
+                               p_rule=by_name[rule]))
+    return ths[-1]
+
+
+_worker_sampler = None
+
+
+def _init_worker(source, depth, n_axioms):
+    global _worker_sampler
+    fs = FormalSystem()
+    fs.read_formal_system(source)
+    _worker_sampler = Sampler(fs, depth=depth, n_axioms=n_axioms)
+
+
+def _sample_chunk(args):
+    seed, chunk, walks = args
+    s = _worker_sampler
+    s.reset(seed='%s/%s' % (seed, chunk))
+
+    # Each chunk deduplicates its own theorems, the caller does the rest
+    return [flatten(th) for th in s.sample(walks, max_walks=walks)]
+
+
+def sample_parallel(source, n, seed=None, depth=10, n_axioms=100,
+                    processes=None, chunk_size=100, max_walks=None):
+    """Yield n distinct theorems, sampled by several processes.
+
+    Each process loads the formal system from the YAML file source,
+    and runs chunks of chunk_size walks. Chunks are seeded from seed
+    and their index, so results do not depend on scheduling.
+    depth must be picklable, like an int or UniformDepth.
+    """
+    if seed is None:
+        seed = random.SystemRandom().getrandbits(64)
+
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+
+    if max_walks is None:
+        max_walks = 10 * n
+
+    fs = FormalSystem()
+    fs.read_formal_system(source)
+
+    seen = set()
+    pool = multiprocessing.Pool(processes, _init_worker, (source, depth, n_axioms))
+
+    try:
+        for batch in count(0, processes):
+            if len(seen) >= n or batch * chunk_size >= max_walks:
+                return
+
+            tasks = [(seed, chunk, chunk_size)
+                     for chunk in range(batch, batch + processes)]
+
+            # The whole batch is done before we yield, so no task is
+            # left running when the caller stops early
+            for nodes in (nodes for res in pool.map(_sample_chunk, tasks) for nodes in res):
+                string = nodes[-1][0]
+                if string in seen:
+                    continue
+                seen.add(string)
+                yield unflatten(nodes, fs.rules)
+
+                if len(seen) >= n:
+                    return
+    finally:
+        pool.close()
+        pool.join()
@@ -0,0 +1,455 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Compact binary files for closures, with their derivations.
+
+A closure is written generation by generation while it is computed,
+and read back with a memory map: opening a file does not parse it,
+and records are decoded straight from the map when they are accessed.
+
+Layout, integers being little endian, and varints LEB128:
+
+- header: magic
+- records, one per theorem and generation:
+  varint length, utf-8 string, varint generation,
+  varint rule id (0 for starting points), varint number of parents,
+  varint parent record ids
+- rules: varint count, then for each rule its name and description,
+  as varint length and utf-8 string
+- offsets of records (uint64 each)
+- first record id of each generation (uint64 each)
+- hash table for membership, open addressing on crc32 of the strings,
+  slots hold first record id + 1, 0 being empty (uint64 each)
+- footer: counts and offsets of the sections, see FOOTER, then magic
+"""
+
+from __future__ import absolute_import
+
+import codecs
+import mmap
+import struct
+import zlib
+
+from .formalsystems import Theorem
+
+
+MAGIC = b'FSC\x01'
+
+# n_records, n_distinct, n_generations,
+# rules, offsets, generations, table offsets, table size
+FOOTER = struct.Struct('<8Q4s')
+
+UINT64 = struct.Struct('<Q')
+
+
+def _crc(data):
+    return zlib.crc32(data) & 0xffffffff
+
+
+def encode_varint(n):
+    """
+    >>> list(encode_varint(1)), list(encode_varint(300))
+    ([1], [172, 2])
+    """
+    out = bytearray()
+    while n >= 0x80:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+    return out
+
+
+def decode_varint(buf, pos=0):
+    """Read a varint in buf, return it with the next position.
+
+    buf is a bytearray, or a memory map.
+
+    >>> decode_varint(encode_varint(300) + encode_varint(1))
+    (300, 2)
+    """
+    n = shift = 0
+    while True:
+        b = buf[pos]
+        if not isinstance(b, int):
+            # Python 2 memory maps give characters
+            b = ord(b)
+        pos += 1
+        n |= (b & 0x7f) << shift
+        if b < 0x80:
+            return n, pos
+        shift += 7
+
+
+def _encode_string(s):
+    data = s.encode('utf-8')
+    return encode_varint(len(data)) + data
+
+
+def _write_uint64s(f, values, chunk=4096):
+    for i in range(0, len(values), chunk):
+        part = values[i:i + chunk]
+        f.write(struct.pack('<%dQ' % len(part), *part))
+
+
+class ClosureWriter(object):
+    """Stream theorems to a file.
+
+    Theorems are deduplicated within a generation. Each written theorem
+    remembers its record id, so parents are referenced to the record
+    they were written as; parents never written are written first,
+    with the same generation. Only the index of strings stays in memory,
+    not the theorems.
+
+    With resume, a ClosureFile, its records are copied first, so the
+    theorems it built keep their record ids. Generations given to add
+    and extend then follow its generations, starting with its last one.
+    """
+    def __init__(self, path, resume=None):
+        self._f = open(path, 'wb')
+        self._f.write(MAGIC)
+        self._pos = len(MAGIC)
+
+        # Tags the record ids set on theorems
+        self.key = object()
+        # string -> (last record id, its generation)
+        self._last = {}
+        self._offsets = []
+        # first record id of each generation
+        self._generations = []
+        # crc32 and record id of the first record of each string
+        self._crcs = []
+        self._firsts = []
+        # rule -> rule id, and (name, description) of each rule id
+        self._rules = {}
+        self._rule_list = []
+        self.generation = 1
+
+        if resume is not None:
+            self._copy(resume)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def _copy(self, cf, chunk=1 << 20):
+        # Records are copied as is, their ids do not change
+        for i in range(len(MAGIC), cf._rules_offset, chunk):
+            self._f.write(cf._mm[i:min(i + chunk, cf._rules_offset)])
+        self._pos = cf._rules_offset
+
+        for i in range(cf.n_records):
+            string, generation, _, _ = cf.record(i)
+            if string not in self._last:
+                self._crcs.append(_crc(string.encode('utf-8')))
+                self._firsts.append(i)
+            self._last[string] = i, generation
+            self._offsets.append(cf._offset(i))
+
+        self._generations = [cf._first_id(g) for g in range(1, cf.generations + 1)]
+        self._rule_list = list(cf._rule_table)
+        self._rules = dict((rule, i) for i, rule in enumerate(cf.rules) if i)
+
+        self.key = cf.key
+        self.generation = cf.generations
+
+    def _rule_id(self, rule):
+        if rule not in self._rules:
+            self._rule_list.append((str(getattr(rule, 'name', rule)), str(rule)))
+            self._rules[rule] = len(self._rule_list)
+        return self._rules[rule]
+
+    def _parent(self, p, generation):
+        if p.record is not None and p.record[0] is self.key:
+            return p.record[1]
+        return self._add(p, generation)
+
+    def add(self, th, generation=None):
+        """Write th, return its record id.
+
+        generation defaults to the current generation, and may not
+        be lower than the generation of the previous record.
+        """
+        if generation is None:
+            generation = self.generation
+        return self._add(th, generation)
+
+    def _add(self, th, generation):
+        if generation < self.generation:
+            raise ValueError('Generation %s after generation %s' %
+                             (generation, self.generation))
+        self.generation = generation
+
+        last = self._last.get(th.string)
+        if last is not None and last[1] == generation:
+            th.record = self.key, last[0]
+            return last[0]
+
+        parents = [self._parent(p, generation) for p in th.parents]
+        rule = self._rule_id(th.p_rule) if th.parents else 0
+
+        data = th.string.encode('utf-8')
+        record = encode_varint(len(data)) + data
+        record += encode_varint(generation)
+        record += encode_varint(rule)
+        record += encode_varint(len(parents))
+        for p in parents:
+            record += encode_varint(p)
+
+        i = len(self._offsets)
+        while len(self._generations) < generation:
+            self._generations.append(i)
+
+        if last is None:
+            self._crcs.append(_crc(data))
+            self._firsts.append(i)
+
+        self._last[th.string] = i, generation
+        self._offsets.append(self._pos)
+        self._f.write(record)
+        self._pos += len(record)
+
+        th.record = self.key, i
+        return i
+
+    def extend(self, ths, generation=None):
+        """Write all theorems of ths in a generation, by default
+        the one after the current generation, except for the first one.
+        """
+        if generation is None:
+            generation = self.generation + 1 if self._offsets else self.generation
+        for th in ths:
+            self._add(th, generation)
+        self.generation = generation
+
+    def close(self):
+        if self._f is None:
+            return
+        f = self._f
+
+        rules = self._pos
+        f.write(encode_varint(len(self._rule_list)))
+        for name, description in self._rule_list:
+            f.write(_encode_string(name))
+            f.write(_encode_string(description))
+
+        offsets = f.tell()
+        _write_uint64s(f, self._offsets)
+
+        generations = f.tell()
+        _write_uint64s(f, self._generations)
+
+        size = 1
+        while size < 2 * len(self._firsts):
+            size *= 2
+
+        table = [0] * size
+        for crc, i in zip(self._crcs, self._firsts):
+            h = crc & (size - 1)
+            while table[h]:
+                h = (h + 1) & (size - 1)
+            table[h] = i + 1
+
+        table_offset = f.tell()
+        _write_uint64s(f, table)
+
+        f.write(FOOTER.pack(len(self._offsets), len(self._firsts),
+                            len(self._generations), rules, offsets,
+                            generations, table_offset, size, MAGIC))
+        f.close()
+        self._f = None
+        self._last = None
+
+
+def dump(path, steps, step):
+    """Write generations (i, ths) of steps, up to generation step,
+    and return the number of records.
+
+    steps is like the output of FormalSystem._apply_rules_step.
+    """
+    with ClosureWriter(path) as w:
+        for i, ths in steps:
+            w.extend(ths, i)
+            if i >= step:
+                break
+        return len(w)
+
+
+class ClosureFile(object):
+    """Memory mapped closure file.
+
+    Theorems are rebuilt with their derivations, with the rules
+    of the formal system fs, or a description of the rules if not given.
+
+    >>> import os, tempfile
+    >>> from formalsystems.formalsystems import FormalSystem
+    >>> fs = FormalSystem()
+    >>> fs.read_formal_system('./definitions/MIU.yaml')
+    >>> path = os.path.join(tempfile.mkdtemp(), 'MIU.fsc')
+    >>> dump(path, fs._apply_rules_step(fs.iterate_over_schema(), verbose=False), 3)
+    6
+    >>> with ClosureFile(path, fs) as cf:
+    ...     len(cf), cf.generations, 'MIUIU' in cf, 'MU' in cf
+    ...     print('/'.join(cf.strings(3)))
+    ...     th = cf.theorem('MIUIU')
+    ...     ths = fs.apply_rules_step(cf.frontier(), 2, verbose=False)
+    (6, 3, True, False)
+    MIIU/MIUIU/MIIII
+    STEP 1: MIIU/MIUIU/MIIII
+    STEP 2: MIIIIU/MIIUIIU/MIUIUIUIU/MIIIIIIII/MIU/MUI
+    >>> [str(t) for _, t in fs.th_to_derivation(th, th, verbose=False)]
+    ['MI', 'MIU', 'MIUIU']
+    >>> th.p_rule is fs.rules[1]
+    True
+    """
+    def __init__(self, path, fs=None):
+        self._file = open(path, 'rb')
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            self._view = memoryview(self._mm)
+        except TypeError:
+            # Python 2 memory maps do not support memoryview
+            self._view = None
+        # Tags the record ids set on built theorems
+        self.key = object()
+
+        if self._mm[:len(MAGIC)] != MAGIC or self._mm[-len(MAGIC):] != MAGIC:
+            self.close()
+            raise ValueError('%s is not a closure file' % path)
+
+        (self.n_records, self._n_distinct, self.generations, rules,
+         self._offsets, self._first_ids, self._table,
+         self._table_size, _) = FOOTER.unpack_from(self._mm, len(self._mm) - FOOTER.size)
+
+        self._rules_offset = rules
+        self.rules = [None]
+        self._rule_table = []
+        by_name = dict((str(r.name), r) for r in fs.rules) if fs is not None else {}
+
+        n, pos = decode_varint(self._mm, rules)
+        for _ in range(n):
+            length, pos = decode_varint(self._mm, pos)
+            name = self._text(pos, pos + length)
+            pos += length
+            length, pos = decode_varint(self._mm, pos)
+            description = self._text(pos, pos + length)
+            pos += length
+            self._rule_table.append((name, description))
+            self.rules.append(by_name.get(name, description))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self._view is not None:
+            self._view.release()
+            self._view = None
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+        self._file.close()
+
+    def __len__(self):
+        """Number of distinct theorems."""
+        return self._n_distinct
+
+    def _offset(self, i):
+        return UINT64.unpack_from(self._mm, self._offsets + 8 * i)[0]
+
+    def _first_id(self, generation):
+        return UINT64.unpack_from(self._mm, self._first_ids + 8 * (generation - 1))[0]
+
+    def _bytes(self, start, end):
+        # A view on the map, or a copy on Python 2
+        if self._view is None:
+            return self._mm[start:end]
+        return self._view[start:end]
+
+    def _text(self, start, end):
+        return codecs.utf_8_decode(self._bytes(start, end))[0]
+
+    def record(self, i):
+        """Record i as (string, generation, rule id, parent record ids)."""
+        length, pos = decode_varint(self._mm, self._offset(i))
+        string = self._text(pos, pos + length)
+        generation, pos = decode_varint(self._mm, pos + length)
+        rule, pos = decode_varint(self._mm, pos)
+        n, pos = decode_varint(self._mm, pos)
+        parents = []
+        for _ in range(n):
+            p, pos = decode_varint(self._mm, pos)
+            parents.append(p)
+        return string, generation, rule, tuple(parents)
+
+    def lookup(self, th):
+        """Id of the first record of th, or None."""
+        data = str(th).encode('utf-8')
+        mask = self._table_size - 1
+        h = _crc(data) & mask
+
+        while True:
+            slot = UINT64.unpack_from(self._mm, self._table + 8 * h)[0]
+            if not slot:
+                return
+            length, pos = decode_varint(self._mm, self._offset(slot - 1))
+            if length == len(data) and self._bytes(pos, pos + length) == data:
+                return slot - 1
+            h = (h + 1) & mask
+
+    def __contains__(self, th):
+        return self.lookup(th) is not None
+
+    def _ids(self, generation):
+        if not 1 <= generation <= self.generations:
+            return range(0)
+        end = self._first_id(generation + 1) if generation < self.generations else self.n_records
+        return range(self._first_id(generation), end)
+
+    def strings(self, generation):
+        return [self.record(i)[0] for i in self._ids(generation)]
+
+    def _theorems(self, ids):
+        built = {}
+
+        def build(i):
+            if i not in built:
+                string, _, rule, parents = self.record(i)
+                if not parents:
+                    built[i] = Theorem(string)
+                else:
+                    built[i] = Theorem(string,
+                                       parents=[build(p) for p in parents],
+                                       p_rule=self.rules[rule])
+                # Known by a ClosureWriter resuming this file
+                built[i].record = self.key, i
+            return built[i]
+
+        return [build(i) for i in ids]
+
+    def theorem(self, th):
+        """First found theorem for th, with its derivation, or None."""
+        i = self.lookup(th)
+        if i is None:
+            return
+        return self._theorems([i])[0]
+
+    def generation(self, generation):
+        """Theorems of a generation, with their derivations."""
+        return self._theorems(self._ids(generation))
+
+    def frontier(self):
+        """Theorems of the last generation, to resume computation."""
+        return self.generation(self.generations)
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
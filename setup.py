@@ -28,9 +28,11 @@ setup(
         'FormalSystemsMain',
     ],
     install_requires=[
-        'lepl',
         'pyyaml'
     ],
+    extras_require={
+        'lepl': ['lepl'],
+    },
     entry_points={
         'console_scripts': [
             'FormalSystems = FormalSystemsMain:main',
@@ -5,7 +5,20 @@ import unittest
 import doctest
 
 import os
+import re
 import sys
+import shutil
+import tempfile
+import threading
+import time
+from itertools import product
+
+try:
+    from io import StringIO
+    from urllib.request import urlopen
+except ImportError:  # Python 2
+    from StringIO import StringIO
+    from urllib2 import urlopen
 
 # Managing path
 DIRNAME = os.path.abspath(os.path.dirname(__file__))
@@ -15,7 +28,28 @@ if UP_DIR not in sys.path:
     sys.path.append(UP_DIR)
 
 # Now we can import the tested packages/modules
-from formalsystems import formalsystems, leplparsing
+from formalsystems import formalsystems, leplparsing, matching, rulegraph, closure, sampling, distributed, storage, rewriting, metrics
+
+
+def definition(name):
+    return os.path.join(DIRNAME, 'definitions', name)
+
+
+def load(name):
+    fs = formalsystems.FormalSystem()
+    fs.read_formal_system(definition(name))
+    return fs
+
+
+def check_derivation(test, fs, th):
+    if not th.parents:
+        test.assertTrue(fs.is_axiom(th, verbose=False))
+        return
+
+    produced = th.p_rule.produce_one(th.parents, verbose=False)
+    test.assertTrue(th.string in [str(t) for t in produced if t is not None])
+    for p in th.parents:
+        check_derivation(test, fs, p)
 
 
 class TestFormalSystems(unittest.TestCase):
@@ -23,6 +57,616 @@ class TestFormalSystems(unittest.TestCase):
         pass
 
 
+class TestMatching(unittest.TestCase):
+    CASES = [
+        (('xIIIy',), {'x': '.*', 'y': '.*'}),
+        (('xUUy',), {'x': '.*', 'y': '.*'}),
+        (('Mx',), {'x': '.*'}),
+        (('xpygz',), {'x': '-+', 'y': '-+', 'z': '-+'}),
+        (('zSDx', 'x-NDPz'), {'x': '-+', 'z': '-+'}),
+        (('xNDPx',), {'x': '-+'}),
+    ]
+
+    STRINGS = [''.join(p) for n in range(4) for p in product('MIU-pgSD', repeat=n)]
+    STRINGS += ['MIIII', 'MIUUIUU', '--p---g----', '-----SD---', '--NDP--']
+
+    def test_axiom(self):
+        fs = load('NDP.yaml')
+        self.assertTrue(fs.is_axiom(formalsystems.Theorem('---NDP--'), verbose=False))
+        self.assertFalse(fs.is_axiom(formalsystems.Theorem('--NDP---'), verbose=False))
+
+    def test_same_as_regex(self):
+        def brute_force(tokens, string, pos=0):
+            # All splits of string, longest values first
+            if not tokens:
+                return [{}] if pos == len(string) else []
+            alias, unit, rep = tokens[0]
+            reg = '.' if unit is None else '(?:%s)' % re.escape(unit)
+            if rep is not None:
+                reg += '{%s,}' % rep
+            found = []
+            for end in range(len(string), pos - 1, -1):
+                if re.match('(?:%s)\\Z' % reg, string[pos:end]):
+                    for m in brute_force(tokens[1:], string, end):
+                        if alias is not None:
+                            m[alias] = string[pos:end]
+                        found.append(m)
+            return found
+
+        # ab* is a repetition of ab here
+        cases = self.CASES + [(('xabyab',), {'x': 'ab*', 'y': '.+'}),
+                              (('xMMy',), {'x': 'M*', 'y': 'I'})]
+        for conds, wildcards in cases:
+            patterns, _ = matching.reg_to_pattern(conds, wildcards)
+
+            for pattern in patterns:
+                for s in self.STRINGS + ['abab-ab', 'MMMMI', 'ababab']:
+                    expected = brute_force(pattern.tokens, s)
+                    self.assertEqual(list(pattern.match_all(s)), expected)
+                    self.assertEqual(pattern.matches(s), bool(expected))
+                    self.assertEqual(pattern.first(s), expected[0] if expected else None)
+
+    def test_first_consistent(self):
+        (p,), aliases = matching.reg_to_pattern(('xNDPx',), {'x': '-+'})
+        self.assertEqual(p.first('--NDP-'), {'x_0': '--', 'x_1': '-'})
+        self.assertEqual(p.first('--NDP-', same=[aliases['x']]), None)
+        self.assertEqual(p.first('--NDP--', same=[aliases['x']]), {'x_0': '--', 'x_1': '--'})
+
+    def test_same_as_lepl(self):
+        if leplparsing.lepl is None:
+            # LEPL not installed, or not supported by this interpreter
+            self.skipTest('LEPL not available')
+
+        for conds, wildcards in self.CASES:
+            lexs, l_aliases = leplparsing.reg_to_lex(conds, wildcards)
+            patterns, p_aliases = matching.reg_to_pattern(conds, wildcards)
+            self.assertEqual(dict(l_aliases), dict(p_aliases))
+
+            for lex, pattern in zip(lexs, patterns):
+                for s in self.STRINGS:
+                    self.assertEqual(list(leplparsing.parse(lex, s)),
+                                     list(matching.parse(pattern, s)))
+
+
+class TestMatchCache(unittest.TestCase):
+    def bucket(self, cache):
+        fs = load('NDP.yaml')
+        fs.cache = cache
+
+        gen = fs._apply_rules_bucket(fs.iterate_over_schema(), full=True, verbose=False)
+        for turn, bucket in gen:
+            if turn >= 8:
+                return [str(t) for t in bucket]
+
+    def test_same_theorems(self):
+        cache = matching.MatchCache()
+        self.assertEqual(self.bucket(cache), self.bucket(None))
+        self.assertTrue(cache.hits > cache.misses > 0)
+        self.assertEqual(cache.evictions, 0)
+
+    def test_bounded(self):
+        cache = matching.MatchCache(maxsize=5)
+        self.assertEqual(self.bucket(cache), self.bucket(None))
+        self.assertEqual(len(cache), 5)
+        self.assertTrue(cache.evictions > 0)
+
+
+class TestRuleGraph(unittest.TestCase):
+    def load(self, name, graph=True):
+        fs = load(name)
+        if not graph:
+            fs.graph = None
+        return fs
+
+    def step(self, fs, step):
+        for i, ths in fs._apply_rules_step(fs.iterate_over_schema(), verbose=False):
+            if i >= step:
+                return [str(t) for t in ths]
+
+    def bucket(self, fs, turns, full=False):
+        gen = fs._apply_rules_bucket(fs.iterate_over_schema(), full, verbose=False)
+        for turn, bucket in gen:
+            if turn >= turns:
+                return [str(t) for t in bucket]
+
+    def test_edges(self):
+        fs = self.load('NDP.yaml')
+        r1, r2, r3, r4 = fs.rules
+
+        self.assertEqual(fs.graph.producers(r2, 0) & set(fs.rules), set([r1]))
+        self.assertEqual(fs.graph.producers(r4, 0), set([r2, r3]))
+        # P theorems are useless
+        self.assertFalse(any(p is r4 for p, _, _ in fs.graph.edges()))
+
+    def test_dot(self):
+        dot = self.load('NDP.yaml').graph.to_dot()
+        self.assertTrue(dot.startswith('digraph "rules" {'))
+        self.assertTrue('    r2 -> r3 [label="1"];' in dot)
+        self.assertTrue('    a1 -> r3 [label="2"];' in dot)
+        self.assertTrue('    r1 -> r2;' in dot)
+
+    def test_same_theorems(self):
+        for graph in (True, False):
+            self.assertEqual(self.step(self.load('MIU.yaml', graph), 6),
+                             self.step(self.load('MIU.yaml'), 6))
+            self.assertEqual(self.bucket(self.load('pg.yaml', graph), 10),
+                             self.bucket(self.load('pg.yaml'), 10))
+
+        self.assertEqual(self.bucket(self.load('NDP.yaml', False), 8, full=True),
+                         self.bucket(self.load('NDP.yaml'), 8, full=True))
+
+
+class TestSampling(unittest.TestCase):
+    def test_derivations(self):
+        for name, depth in [('MIU.yaml', sampling.UniformDepth(1, 5)),
+                            ('NDP.yaml', sampling.GeometricDepth(0.1, 15)),
+                            ('fg.yaml', 10)]:
+            fs = load(name)
+            ths = list(sampling.Sampler(fs, seed=0, depth=depth).sample(30))
+
+            self.assertEqual(len(ths), len(set(str(t) for t in ths)))
+            for th in ths:
+                check_derivation(self, fs, th)
+
+    def test_reproducible(self):
+        fs = load('NDP.yaml')
+
+        def run(seed):
+            s = sampling.Sampler(fs, seed=seed, depth=sampling.UniformDepth(1, 10))
+            return [str(t) for t in s.sample(30)]
+
+        self.assertEqual(run(1), run(1))
+        self.assertNotEqual(run(1), run(2))
+
+    def test_depth(self):
+        fs = load('pg.yaml')
+        s = sampling.Sampler(fs, seed=0, depth=3, n_axioms=1)
+        # Only one axiom, and one rule: only one theorem at depth 3
+        self.assertEqual([str(t) for t in s.sample(5)], ['-p----g-----'])
+
+    def test_flatten(self):
+        fs = load('NDP.yaml')
+        for th in sampling.Sampler(fs, seed=0, depth=10).sample(10):
+            rebuilt = sampling.unflatten(sampling.flatten(th), fs.rules)
+            self.assertEqual(fs.th_to_derivation(th, th, verbose=False),
+                             fs.th_to_derivation(rebuilt, rebuilt, verbose=False))
+
+    def test_parallel(self):
+        def run():
+            return list(sampling.sample_parallel(definition('NDP.yaml'), 40,
+                                                 seed=0,
+                                                 depth=sampling.UniformDepth(1, 10),
+                                                 processes=2,
+                                                 chunk_size=10))
+        ths = run()
+        fs = load('NDP.yaml')
+
+        self.assertEqual(len(ths), 40)
+        self.assertEqual([str(t) for t in ths], [str(t) for t in run()])
+        for th in ths:
+            check_derivation(self, fs, th)
+
+
+class TestSharedClosure(unittest.TestCase):
+    def setUp(self):
+        self.fs = load('MIU.yaml')
+
+    def test_same_generations_as_step(self):
+        shared = closure.SharedClosure(self.fs, self.fs.iterate_over_schema())
+        steps = self.fs._apply_rules_step(self.fs.iterate_over_schema(),
+                                          verbose=False)
+
+        for i, ths in steps:
+            snap = shared.snapshot()
+            self.assertEqual(snap.generation, i)
+            self.assertEqual([str(t) for t in snap.frontier],
+                             [str(t) for t in ths])
+            if i >= 5:
+                break
+            shared.extend()
+
+    def test_derivation(self):
+        shared = closure.SharedClosure(self.fs, self.fs.iterate_over_schema())
+        snap = shared.extend(3)
+
+        report = snap.derivation('MIUIU')
+        self.assertEqual([str(t) for _, t in report], ['MI', 'MIU', 'MIUIU'])
+        self.assertEqual(snap.derivation('MU'), None)
+
+    def test_concurrent_readers(self):
+        shared = closure.SharedClosure(self.fs, self.fs.iterate_over_schema())
+        errors = []
+        done = threading.Event()
+
+        def check(snap):
+            # Each snapshot must be internally consistent
+            assert len(snap) == len(set(str(t) for t in snap))
+            for th in snap.frontier:
+                assert th in snap
+                assert snap.get(th) is not None
+
+        def reader():
+            try:
+                last = 0
+                while not done.is_set():
+                    snap = shared.snapshot()
+                    assert snap.generation >= last
+                    last = snap.generation
+                    check(snap)
+                    # Let the writers run, we are on a single GIL
+                    time.sleep(0.001)
+            except Exception as e:
+                errors.append(e)
+
+        def waiter():
+            try:
+                snap = shared.wait_for(4)
+                assert snap.generation >= 4
+                check(snap)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=reader) for _ in range(8)]
+        threads += [threading.Thread(target=waiter) for _ in range(4)]
+        for t in threads:
+            t.start()
+
+        # Concurrent writers are serialized
+        writers = [threading.Thread(target=shared.extend, args=(1,))
+                   for _ in range(4)]
+        for t in writers:
+            t.start()
+        for t in writers:
+            t.join()
+
+        done.set()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(shared.generation, 5)
+
+    def test_wait_for_timeout(self):
+        shared = closure.SharedClosure(self.fs, self.fs.iterate_over_schema())
+        snap = shared.wait_for(3, timeout=0.01)
+        self.assertEqual(snap.generation, 1)
+
+
+class TestDistributedClosure(unittest.TestCase):
+    def generations(self, name, ths, n_workers, steps):
+        gens = []
+        with distributed.DistributedClosure(definition(name), ths, n_workers) as dc:
+            gens.append(sorted(dc.frontier()))
+            for _ in range(steps - 1):
+                dc.extend()
+                gens.append(sorted(dc.frontier()))
+        return gens
+
+    def test_same_generations_as_step(self):
+        for name, n_axioms in [('MIU.yaml', None), ('NDP.yaml', 15)]:
+            fs = load(name)
+            axioms = list(fs.iterate_over_schema(max_iter=n_axioms))
+
+            expected = []
+            for i, ths in fs._apply_rules_step(axioms, verbose=False):
+                expected.append(sorted(str(t) for t in ths))
+                if i >= 6:
+                    break
+
+            for n_workers in (1, 3):
+                self.assertEqual(self.generations(name, axioms, n_workers, 6), expected)
+
+    def test_derivation(self):
+        fs = load('NDP.yaml')
+        axioms = list(fs.iterate_over_schema(max_iter=15))
+
+        with distributed.DistributedClosure(definition('NDP.yaml'), axioms, 3) as dc:
+            dc.extend(6)
+            self.assertTrue('-----SD--' in dc)
+            self.assertFalse('----SD--' in dc)
+            self.assertEqual(dc.theorem('----SD--'), None)
+
+            for string in dc.frontier():
+                th = dc.theorem(string)
+                self.assertEqual(str(th), string)
+                check_derivation(self, fs, th)
+
+    def test_error(self):
+        # Only one shard fails, the other one must not wait for it
+        tmp = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp, 'broken.yaml')
+            with open(path, 'w') as f:
+                f.write('axioms:\n    - ab\nrules:\n    - x is .*, xb => x%b\n')
+            fs = formalsystems.FormalSystem()
+            fs.read_formal_system(path)
+
+            with distributed.DistributedClosure(path, fs.iterate_over_schema(), 2) as dc:
+                self.assertRaises(TypeError, dc.extend, 1)
+        finally:
+            shutil.rmtree(tmp)
+
+
+class TestStorage(unittest.TestCase):
+    def setUp(self):
+        self.fs = load('MIU.yaml')
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'closure.fsc')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def steps(self, ths, step, start=1):
+        for i, ths in self.fs._apply_rules_step(ths, verbose=False, start=start):
+            yield i, ths
+            if i >= step:
+                return
+
+    def test_generations(self):
+        expected = [[str(t) for t in ths] for _, ths in self.steps(self.fs.iterate_over_schema(), 7)]
+        storage.dump(self.path, self.steps(self.fs.iterate_over_schema(), 7), 7)
+
+        with storage.ClosureFile(self.path, self.fs) as cf:
+            self.assertEqual(cf.generations, 7)
+            self.assertEqual([cf.strings(i) for i in range(1, 8)], expected)
+            self.assertEqual(cf.strings(8), [])
+
+            strings = set(s for g in expected for s in g)
+            self.assertEqual(len(cf), len(strings))
+            for s in strings:
+                self.assertTrue(s in cf)
+            for s in ['MU', 'M', 'MIIIIIIIIIIIIIIIIIIIIIIIIIIIIIIIIIIIIIIIIIIIIIIIIIIIIIIIIIIIIIIIII']:
+                self.assertFalse(s in cf)
+                self.assertEqual(cf.theorem(s), None)
+
+            for th in cf.frontier():
+                check_derivation(self, self.fs, th)
+
+    def check_same_derivations(self, fs, cf, gens):
+        for g, ths in enumerate(gens, start=1):
+            self.assertEqual(cf.strings(g), [str(t) for t in ths])
+            for th, expected in zip(cf.generation(g), ths):
+                self.assertEqual(fs.th_to_derivation(th, th, verbose=False),
+                                 fs.th_to_derivation(expected, expected, verbose=False))
+
+    def test_same_derivations(self):
+        gens = [ths for _, ths in self.steps(self.fs.iterate_over_schema(), 8)]
+        storage.dump(self.path, enumerate(gens, start=1), 8)
+
+        with storage.ClosureFile(self.path, self.fs) as cf:
+            self.check_same_derivations(self.fs, cf, gens)
+
+    def test_same_derivations_bucket(self):
+        # Parents may come from any previous bucket
+        fs = load('NDP.yaml')
+
+        gens = []
+        with storage.ClosureWriter(self.path) as w:
+            for turn, bucket in fs._apply_rules_bucket(fs.iterate_over_schema(), full=True, verbose=False):
+                w.extend(bucket, turn)
+                gens.append(list(bucket))
+                if turn >= 8:
+                    break
+
+        with storage.ClosureFile(self.path, fs) as cf:
+            self.check_same_derivations(fs, cf, gens)
+
+    def test_resume_output(self):
+        storage.dump(self.path, self.steps(self.fs.iterate_over_schema(), 4), 4)
+        resumed = os.path.join(self.tmp, 'resumed.fsc')
+
+        with storage.ClosureFile(self.path, self.fs) as cf:
+            with storage.ClosureWriter(resumed, resume=cf) as w:
+                for i, ths in self.steps(cf.frontier(), 6, start=cf.generations):
+                    w.extend(ths, i)
+
+        # Saved generations are kept, new ones follow them
+        gens = [ths for _, ths in self.steps(self.fs.iterate_over_schema(), 6)]
+        with storage.ClosureFile(resumed, self.fs) as cf:
+            self.assertEqual(cf.generations, 6)
+            self.check_same_derivations(self.fs, cf, gens)
+
+    def test_resume(self):
+        storage.dump(self.path, self.steps(self.fs.iterate_over_schema(), 4), 4)
+        expected = [str(t) for _, ths in self.steps(self.fs.iterate_over_schema(), 6) for t in ths]
+
+        with storage.ClosureFile(self.path, self.fs) as cf:
+            steps = list(self.steps(cf.frontier(), 6, start=cf.generations))
+
+        # Steps keep the numbering of the saved closure
+        self.assertEqual([i for i, _ in steps], [4, 5, 6])
+        resumed = [str(t) for _, ths in steps for t in ths]
+        self.assertEqual(resumed, expected[-len(resumed):])
+
+    def test_writer(self):
+        ax = formalsystems.Theorem('MI')
+        th = formalsystems.Theorem('MIIU',
+                                   parents=[formalsystems.Theorem('MII', parents=[ax],
+                                                                  p_rule=self.fs.rules[1])],
+                                   p_rule=self.fs.rules[0])
+
+        with storage.ClosureWriter(self.path) as w:
+            # Parents are written first, in the same generation
+            self.assertEqual(w.add(th, 2), 2)
+            self.assertEqual(w.add(th, 2), 2)
+            self.assertEqual(w.add(ax, 3), 3)
+            self.assertRaises(ValueError, w.add, ax, 2)
+
+        with storage.ClosureFile(self.path) as cf:
+            self.assertEqual((len(cf), cf.n_records), (3, 4))
+            self.assertEqual(cf.strings(1), [])
+            self.assertEqual(cf.strings(2), ['MI', 'MII', 'MIIU'])
+            self.assertEqual(cf.strings(3), ['MI'])
+            # Without formal system, rules are described
+            self.assertEqual(cf.theorem('MIIU').p_rule, str(self.fs.rules[0]))
+
+    def test_not_a_closure(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'MI' * 100)
+        self.assertRaises(ValueError, storage.ClosureFile, self.path)
+
+
+class TestRewriteOrder(unittest.TestCase):
+    SYSTEMS = [
+        (['abab'], ['x y are .*, xaby => xbay', 'x y are .*, xbby => xy']),
+        (['aab', 'b'], ['x y are .*, xay => xbby', 'x is .*, xb => xab', 'y is .*, by => ay']),
+        (['ab'], ['x y are .*, xay => xaay', 'x is .*, bx => bxx', 'x y are .*, xaaay => xby']),
+    ]
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def load(self, axioms, rules):
+        path = os.path.join(self.tmp, 'system.yaml')
+        with open(path, 'w') as f:
+            f.write('axioms:\n')
+            f.writelines('    - %s\n' % ax for ax in axioms)
+            f.write('rules:\n')
+            f.writelines('    - %s\n' % r for r in rules)
+        fs = formalsystems.FormalSystem()
+        fs.read_formal_system(path)
+        return fs
+
+    def generations(self, fs, step):
+        gens = []
+        for i, ths in fs._apply_rules_step(fs.iterate_over_schema(), verbose=False):
+            gens.append(ths)
+            if i >= step:
+                return gens
+
+    def check_same_closure(self, fs, step):
+        expected = [set(str(t) for t in ths) for ths in self.generations(fs, step)]
+        fs.order = rewriting.RewriteOrder(fs.rules)
+        gens = self.generations(fs, step)
+
+        self.assertEqual([set(str(t) for t in ths) for ths in gens], expected)
+        for th in gens[-1]:
+            check_derivation(self, fs, th)
+
+    def test_miu(self):
+        fs = load('MIU.yaml')
+        self.check_same_closure(fs, 8)
+
+    def test_systems(self):
+        for axioms, rules in self.SYSTEMS:
+            self.check_same_closure(self.load(axioms, rules), 7)
+
+    def test_fewer_productions(self):
+        fs = load('MIU.yaml')
+        ths = self.generations(fs, 6)[-1]
+        produced = len(list(fs.apply_rules(ths, verbose=False)))
+
+        fs.order = rewriting.RewriteOrder(fs.rules)
+        ths = self.generations(fs, 6)[-1]
+        self.assertTrue(len(list(fs.apply_rules(ths, verbose=False))) < produced)
+
+    def test_bucket(self):
+        fs = load('pg.yaml')
+        # Context is not any string, nothing to reorder
+        self.assertEqual(rewriting.RewriteOrder(fs.rules).rewrites, {})
+
+        def buckets(fs):
+            result = []
+            for turn, bucket in fs._apply_rules_bucket(fs.iterate_over_schema(), verbose=False):
+                result.append(set(str(t) for t in bucket))
+                if turn >= 10:
+                    return result
+
+        fs = self.load(['x is a+, xb'], ['x y are .*, xaby => xbay', 'x is .*, xb => xbb'])
+        expected = buckets(fs)
+        fs.order = rewriting.RewriteOrder(fs.rules)
+        self.assertEqual(buckets(fs), expected)
+
+    def test_several_premises(self):
+        fs = load('NDP.yaml')
+        self.assertRaises(ValueError, rewriting.RewriteOrder, fs.rules)
+
+    def test_unproduced(self):
+        # Failed matches are reported, whatever the bound
+        fs = load('MIU.yaml')
+        order = rewriting.RewriteOrder(fs.rules)
+        rule = [r for r in fs.rules if r.name == 1][0]
+
+        th = formalsystems.Theorem('MIIU')
+        th.bound = 3
+        self.assertEqual(list(order.produce(rule, th)), [None])
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.fs = load('MIU.yaml')
+        self.fs.metrics = metrics.Metrics(size=3)
+
+    def test_counters(self):
+        fs = load('MIU.yaml')
+        sizes = []
+        for i, ths in fs._apply_rules_step(fs.iterate_over_schema(), verbose=False):
+            sizes.append(len(ths))
+            if i >= 6:
+                break
+
+        for i, ths in self.fs._apply_rules_step(self.fs.iterate_over_schema(), verbose=False):
+            if i >= 6:
+                break
+
+        m = self.fs.metrics
+        self.assertEqual(m.generation, 6)
+        self.assertEqual(m.theorems, sum(sizes[1:]))
+        self.assertEqual(sum(m.firings.values()), m.theorems + m.duplicates)
+        # Ring buffer
+        self.assertEqual([s.generation for s in m.history], [4, 5, 6])
+        self.assertEqual([s.theorems for s in m.history], sizes[3:])
+        self.assertTrue(m.throughput > 0)
+
+    def test_prometheus(self):
+        for i, ths in self.fs._apply_rules_step(self.fs.iterate_over_schema(), verbose=False):
+            if i >= 4:
+                break
+
+        text = self.fs.metrics.prometheus()
+        values = dict(line.rsplit(' ', 1) for line in text.splitlines()
+                      if not line.startswith('#'))
+        self.assertEqual(values['formalsystems_generation'], '4')
+        self.assertEqual(values['formalsystems_theorems_total'], '11')
+        self.assertEqual(values['formalsystems_rule_firings_total{rule="2"}'], '6')
+
+        server = metrics.serve(self.fs.metrics, port=0)
+        try:
+            url = 'http://127.0.0.1:%s/metrics' % server.server_address[1]
+            scraped = urlopen(url).read().decode('utf-8')
+            # Only the memory size may change
+            self.assertEqual(scraped.split('formalsystems_rss_bytes ')[0],
+                             text.split('formalsystems_rss_bytes ')[0])
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_within_generation(self):
+        # Counters move before the generation, or even a rule, is done
+        ths = formalsystems.OrderedSet(self.fs.iterate_over_schema())
+        produced = self.fs.apply_rules(ths, verbose=False)
+        next(produced)
+
+        m = self.fs.metrics
+        self.assertEqual((m.generation, m.produced), (1, 1))
+        self.assertTrue('| 1 produced |' in m.line())
+        self.assertTrue('formalsystems_produced 1\n' in m.prometheus())
+
+        self.fs.collect(produced)
+        self.assertEqual((m.generation, m.produced), (2, 0))
+
+    def test_progress(self):
+        stream = StringIO()
+        with metrics.Progress(self.fs.metrics, interval=0.01, stream=stream):
+            time.sleep(0.1)
+        lines = stream.getvalue().splitlines()
+        self.assertTrue(lines)
+        self.assertTrue(lines[0].startswith('gen 1 | 0 theorems'))
+
+
 if __name__ == '__main__':
 
     # Going in tests directory
@@ -37,9 +681,28 @@ if __name__ == '__main__':
 
     tests = unittest.TestSuite()
 
-    tests.addTests(unittest.makeSuite(TestFormalSystems))
+    loader = unittest.TestLoader()
+
+    tests.addTests(loader.loadTestsFromTestCase(TestFormalSystems))
+    tests.addTests(loader.loadTestsFromTestCase(TestMatching))
+    tests.addTests(loader.loadTestsFromTestCase(TestMatchCache))
+    tests.addTests(loader.loadTestsFromTestCase(TestRuleGraph))
+    tests.addTests(loader.loadTestsFromTestCase(TestSampling))
+    tests.addTests(loader.loadTestsFromTestCase(TestSharedClosure))
+    tests.addTests(loader.loadTestsFromTestCase(TestDistributedClosure))
+    tests.addTests(loader.loadTestsFromTestCase(TestStorage))
+    tests.addTests(loader.loadTestsFromTestCase(TestRewriteOrder))
+    tests.addTests(loader.loadTestsFromTestCase(TestMetrics))
     tests.addTests(doctest.DocTestSuite(formalsystems))
     tests.addTests(doctest.DocTestSuite(leplparsing))
+    tests.addTests(doctest.DocTestSuite(matching))
+    tests.addTests(doctest.DocTestSuite(rulegraph))
+    tests.addTests(doctest.DocTestSuite(sampling))
+    tests.addTests(doctest.DocTestSuite(closure))
+    tests.addTests(doctest.DocTestSuite(distributed))
+    tests.addTests(doctest.DocTestSuite(storage))
+    tests.addTests(doctest.DocTestSuite(rewriting))
+    tests.addTests(doctest.DocTestSuite(metrics))
     tests.addTests(doctest.DocFileSuite('./README.rst',
                                         module_relative=False,
                                         optionflags=flags))